@@ -0,0 +1,157 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Lists documents for bulk ingestion
+
+import boto3
+import hashlib
+import json
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import quote_plus
+
+s3 = boto3.client('s3')
+dynamodb = boto3.resource('dynamodb')
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Documents handed to the Map state per page
+BULK_INGEST_PAGE_SIZE = int(os.environ.get("BULK_INGEST_PAGE_SIZE", "50"))
+# Pages per execution, keeping each execution well below the 25,000 history events quota
+BULK_INGEST_PAGES_PER_EXECUTION = int(os.environ.get("BULK_INGEST_PAGES_PER_EXECUTION", "40"))
+BULK_INGEST_PREFIX = os.environ.get("BULK_INGEST_PREFIX", "public/bulk/")
+SUPPORTED_EXTENSIONS = ("pdf", "tif", "tiff", "png", "jpg", "jpeg")
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+HASH_CONCURRENCY = 10
+
+def list_prefix_page(bucket, prefix, continuation_token):
+    request = {'Bucket': bucket, 'Prefix': prefix, 'MaxKeys': BULK_INGEST_PAGE_SIZE}
+    if continuation_token:
+        request['ContinuationToken'] = continuation_token
+    response = s3.list_objects_v2(**request)
+    keys = [obj['Key'] for obj in response.get('Contents', [])]
+    return keys, response.get('NextContinuationToken'), None
+
+def list_manifest_page(bucket, manifest_key, offset):
+    """A manifest is a text object with one input bucket key per line."""
+    body = s3.get_object(Bucket=bucket, Key=manifest_key)['Body'].read().decode('utf-8')
+    keys = [line.strip() for line in body.splitlines() if line.strip()]
+    offset = offset or 0
+    next_offset = offset + BULK_INGEST_PAGE_SIZE
+    return keys[offset:next_offset], next_offset if next_offset < len(keys) else None, len(keys)
+
+def get_document_id(key):
+    return key.replace("public/", "")
+
+def get_content_hash(bucket, key):
+    """SHA-256 of the object, streamed so large PDFs are never held in memory."""
+    digest = hashlib.sha256()
+    body = s3.get_object(Bucket=bucket, Key=key)['Body']
+    for chunk in body.iter_chunks(chunk_size=HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def get_completed(table_name, document_ids):
+    """Ids of documents already embedded, so a restarted load skips them."""
+    completed = set()
+    for i in range(0, len(document_ids), 100):
+        request = {table_name: {'Keys': [{'id': document_id} for document_id in document_ids[i : i + 100]]}}
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(table_name, []):
+                if item.get('document_status') == "Completed":
+                    completed.add(item['id'])
+            request = response.get('UnprocessedKeys')
+    return completed
+
+def register_documents(table_name, keys, content_hashes, upload_date):
+    table = dynamodb.Table(table_name)
+    with table.batch_writer() as batch:
+        for key in keys:
+            document_id = get_document_id(key)
+            batch.put_item(Item={
+                'id': document_id,
+                'documentName': os.path.splitext(document_id)[0],
+                'document_status': "Queued",
+                'uploadDate': upload_date,
+                'type': os.path.splitext(key)[1].lstrip("."),
+                'vector': "",
+                'content_hash': content_hashes[key],
+            })
+
+def lambda_handler(event, context):
+    """Register one page of documents and return them as pipeline inputs.
+
+    Start the bulk ingest state machine with {"prefix": "public/bulk/"} or
+    {"manifest_key": "<key>"}; the state it returns is passed back for the next page."""
+
+    DOCUMENT_TABLE_NAME = os.environ["DOCUMENT_TABLE_NAME"]
+    bucket = event.get('bucket', os.environ["INPUT_BUCKET_NAME"])
+    progress = event.get('progress', {'listed': 0, 'queued': 0, 'skipped': 0, 'pages': 0})
+
+    if 'manifest_key' in event:
+        keys, next_position, total = list_manifest_page(bucket, event['manifest_key'], event.get('position'))
+    else:
+        keys, next_position, total = list_prefix_page(bucket, event.get('prefix', BULK_INGEST_PREFIX), event.get('position'))
+
+    keys = [key for key in keys if os.path.splitext(key)[1].lstrip(".").lower() in SUPPORTED_EXTENSIONS]
+    # A manifest may list a key twice, which BatchGetItem and batch_writer reject
+    keys = list(dict.fromkeys(keys))
+    completed = get_completed(DOCUMENT_TABLE_NAME, [get_document_id(key) for key in keys])
+    pending = [key for key in keys if get_document_id(key) not in completed]
+
+    with ThreadPoolExecutor(max_workers=HASH_CONCURRENCY) as executor:
+        content_hashes = dict(zip(pending, executor.map(lambda key: get_content_hash(bucket, key), pending)))
+
+    upload_date = datetime.now(timezone.utc).isoformat()
+    register_documents(DOCUMENT_TABLE_NAME, pending, content_hashes, upload_date)
+
+    progress['listed'] += len(keys)
+    progress['queued'] += len(pending)
+    progress['skipped'] += len(keys) - len(pending)
+    progress['pages'] += 1
+    if total is not None:
+        progress['total'] = total
+    logger.info(f"Bulk ingest progress for s3://{bucket}: {json.dumps(progress)}")
+
+    result = {
+        'bucket': bucket,
+        'position': next_position,
+        'has_more': next_position is not None,
+        'progress': progress,
+        'execution_pages': event.get('execution_pages', 0) + 1,
+    }
+    if 'manifest_key' in event:
+        result['manifest_key'] = event['manifest_key']
+    else:
+        result['prefix'] = event.get('prefix', BULK_INGEST_PREFIX)
+
+    # After this page the state machine continues in a fresh execution
+    if result['has_more'] and result['execution_pages'] >= BULK_INGEST_PAGES_PER_EXECUTION:
+        result['next_execution'] = {**result, 'execution_pages': 0}
+        result['has_more'] = False
+
+    # Same shape as the S3 events the pipeline is normally started with
+    result['records'] = [
+        {'Records': [{
+            's3': {'bucket': {'name': bucket}, 'object': {'key': quote_plus(key), 'sha256': content_hashes[key]}},
+            'eventTime': upload_date,
+        }]}
+        for key in pending
+    ]
+    return result
@@ -0,0 +1,96 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Semantic Answer Cache
+
+import os
+import time
+import numpy as np
+
+# Cosine similarity a new question needs to reuse a stored answer
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.95"))
+# Seconds a stored answer may be served
+ANSWER_CACHE_TTL = int(os.environ.get("ANSWER_CACHE_TTL", "3600"))
+# Answers kept per (vectorstore_key, model_id, bot_name, retrieval settings)
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "256"))
+
+# (vectorstore_key, model_id, bot_name, retrieval settings) -> {"etag", "vectors", "answers", "times"}
+# "vectors" holds the unit length question embeddings, one row per answer.
+answer_cache = {}
+
+
+def normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / max(np.linalg.norm(vector), 1e-12)
+
+
+def get_entry(scope, etag):
+    """ Answers stored for scope, dropping them if the vectorstore changed.
+    """
+
+    entry = answer_cache.get(scope)
+    if entry is not None and entry["etag"] == etag:
+        return entry
+
+    entry = {"etag": etag, "vectors": None, "answers": [], "times": []}
+    answer_cache[scope] = entry
+    return entry
+
+
+def keep(entry, mask):
+    entry["vectors"] = entry["vectors"][mask] if mask.any() else None
+    entry["answers"] = [a for a, k in zip(entry["answers"], mask) if k]
+    entry["times"] = [t for t, k in zip(entry["times"], mask) if k]
+
+
+def lookup_answer(scope, etag, vector):
+    """ Stored answer for the most similar earlier question, or None.
+    """
+
+    entry = get_entry(scope, etag)
+    if entry["vectors"] is None:
+        return None
+
+    now = time.time()
+    fresh = np.array([now - t < ANSWER_CACHE_TTL for t in entry["times"]])
+    if not fresh.all():
+        keep(entry, fresh)
+        if entry["vectors"] is None:
+            return None
+
+    scores = entry["vectors"] @ normalize(vector)
+    best = int(np.argmax(scores))
+    print(f"Closest cached question similarity: {scores[best]:.4f}")
+    if scores[best] < ANSWER_CACHE_THRESHOLD:
+        return None
+
+    return entry["answers"][best]
+
+
+def store_answer(scope, etag, vector, answer):
+    entry = get_entry(scope, etag)
+    row = normalize(vector)[np.newaxis, :]
+
+    if entry["vectors"] is None:
+        entry["vectors"] = row
+    else:
+        entry["vectors"] = np.vstack([entry["vectors"], row])
+    entry["answers"].append(answer)
+    entry["times"].append(time.time())
+
+    if len(entry["answers"]) > ANSWER_CACHE_SIZE:
+        mask = np.ones(len(entry["answers"]), dtype=bool)
+        mask[0] = False
+        keep(entry, mask)
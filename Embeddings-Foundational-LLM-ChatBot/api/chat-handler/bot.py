@@ -26,21 +26,31 @@
 # --  -----------------------------------------------------------------
 # --
 
+import json
 import pathlib
+import pickle
 import os
-import uuid
+import shutil
+import threading
+import time
 import zipfile
-import pickle
 import boto3
+import faiss
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+from collections import Counter, OrderedDict
+from decimal import Decimal
 
-from langchain.llms.bedrock import Bedrock
-from langchain.chains.llm import LLMChain
-from langchain.chains import ConversationalRetrievalChain
 from langchain.chains.question_answering import load_qa_chain
-from langchain.memory import ConversationBufferMemory
+from langchain.memory import ConversationBufferWindowMemory
 from langchain.callbacks.manager import CallbackManager
 from langchain.vectorstores.faiss import FAISS
+from answers import lookup_answer, store_answer
+from chains import BudgetedRetrievalChain, QuestionChain
+from docstores import SQLiteDocstore, SQLiteIndexMap
+from retrievers import FederatedRetriever
 from embeddings import get_sagemaker_embeddings
+from llms import Bedrock
 from handlers import MyStdOutCallbackHandler
 from prompts import get_document_prompt, get_question_prompt
 
@@ -48,12 +58,74 @@ CONTEXT_TABLE_NAME = os.environ["CONTEXT_TABLE_NAME"]
 S3_ASSETS_BUCKET_NAME = os.environ["S3_ASSETS_BUCKET_NAME"]
 AWS_INTERNAL = os.environ["AWS_INTERNAL"]
 
+# Seconds a cached vectorstore is trusted before its ETag is checked again
+VECTORSTORE_CACHE_TTL = int(os.environ.get("VECTORSTORE_CACHE_TTL", "300"))
+# Share of the Lambda memory the cached vectorstores are allowed to use
+VECTORSTORE_CACHE_MEMORY_FRACTION = float(os.environ.get("VECTORSTORE_CACHE_MEMORY_FRACTION", "0.5"))
+# Stream answers from Bedrock instead of waiting for the full completion, so
+# server.py can forward the tokens of "stream" requests as they arrive. The
+# stack turns it on; lambda_handler still returns the whole answer at once.
+# AI21 models cannot stream.
+BEDROCK_STREAMING = os.environ.get("BEDROCK_STREAMING", "False").upper() == "TRUE"
+# Number of previous turns read back into the conversation memory
+CHAT_HISTORY_WINDOW = int(os.environ.get("CHAT_HISTORY_WINDOW", "5"))
+
+# Vectorstores loaded by this execution environment, least recently used first.
+# Each entry holds the FAISS store, the S3 ETag it was built from, its size on
+# disk (used as an estimate of resident memory) and when the ETag was last checked.
+vectorstore_cache = OrderedDict()
+# Guards every read, move, insertion and eviction of vectorstore_cache and its
+# stats, since vectorstores are loaded from several threads
+vectorstore_cache_lock = threading.Lock()
+# Local directories being downloaded or opened, by number of loading threads.
+# They are not in vectorstore_cache yet but must not be freed from the disk cache.
+loading_dirs = Counter()
+
+# How load_database was served since this execution environment started:
+# hit (memory, within TTL), revalidate (memory, ETag unchanged), disk (/tmp copy
+# with unchanged ETag) and miss (archive downloaded from S3).
+vectorstore_cache_stats = {"hit": 0, "revalidate": 0, "disk": 0, "miss": 0}
+
+# Retrieval settings used when a bot's CONFIG item does not set them.
+# mmr_lambda switches to maximal marginal relevance search over fetch_k
+# candidates, score_threshold drops weak matches and max_context_tokens caps
+# the documents stuffed into the prompt.
+DEFAULT_RETRIEVAL_CONFIG = {
+    "k": 4,
+    "fetch_k": 20,
+    "mmr_lambda": None,
+    "score_threshold": None,
+    "max_context_tokens": 2000
+}
+
+# Vectorstores searched in parallel by a federated retriever
+FEDERATED_SEARCH_WORKERS = int(os.environ.get("FEDERATED_SEARCH_WORKERS", "8"))
+
+# Archives are named <document>-vectorstore.pkl.zip by the vectorization task,
+# which also uploads the uncompressed files under vectors/<document>/.
+# Their docstore is docstore.db (SQLite), or index.pkl for older uploads.
+VECTORSTORE_ARCHIVE_SUFFIX = "-vectorstore.pkl.zip"
+VECTORSTORE_DOCSTORE_FILES = ["docstore.db", "index.pkl"]
+
+# Manifest of the corpus index maintained by the vectorization task
+CORPUS_MANIFEST_KEY = "corpus/manifest.json"
+
+# Shard archive keys listed by the corpus manifest and when they were read
+corpus_cache = {"keys": None, "checked": 0}
+
+# S3 client shared by all threads; unlike resources, clients are thread safe
+s3_client = boto3.client("s3")
+
+# Question and document chains per (model_id, bot_name). They hold no
+# conversation state, so they are shared by every conversation using them.
+chain_cache = {}
+
 def get_model_args(model_id):   
 
     if model_id.startswith("anthropic"):
 
         question_llm_model_args = { 
-            "max_tokens_to_sample": 7000, 
+            "max_tokens_to_sample": 300, 
             "stop_sequences": [], 
             "temperature": 0.2, 
             "top_p": 0.9,
@@ -69,7 +141,7 @@ def get_model_args(model_id):
     else:
 
         question_llm_model_args = { 
-            "maxTokens": 7000, 
+            "maxTokens": 300, 
             "stopSequences": [], 
             "temperature": 0.7,
             "numResults": 1,
@@ -86,24 +158,156 @@ def get_model_args(model_id):
     return question_llm_model_args, qa_llm_model_args
 
 
-def load_database(vectorstore_key):
-    """ Load the database of knowledge we want to query off of.
+def get_vectorstore_cache_budget():
+    """ Number of bytes the vectorstore cache may hold, bounded by the Lambda memory.
+    """
+
+    memory_size = int(os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "4096"))
+    return int(memory_size * 1024 * 1024 * VECTORSTORE_CACHE_MEMORY_FRACTION)
+
+
+def evict_vectorstores(budget):
+    """ Drop the least recently used vectorstores until the cache fits in budget.
+    """
+
+    total_size = sum(entry["size"] for entry in list(vectorstore_cache.values()))
+    while vectorstore_cache and total_size > budget:
+        evicted_key, evicted = vectorstore_cache.popitem(last=False)
+        total_size -= evicted["size"]
+        print(f"Evicted {evicted_key} from vectorstore cache")
+
+
+def get_local_dir(vectorstore_key):
+    """ Directory in /tmp where the vectorstore archive is expanded.
     """
 
     assert (vectorstore_key.endswith(".zip"))
-    local_zip = f"/tmp/{vectorstore_key}"
-    local_dir = local_zip[:-4]  # remove .zip
+    return f"/tmp/{vectorstore_key}"[:-4]  # remove .zip
+
+
+def read_local_etag(local_dir):
+    """ ETag of the archive expanded in local_dir, or None if there is no usable copy.
+    """
+
+    etag_file = pathlib.Path(f"{local_dir}.etag")
+    if not etag_file.exists():
+        return None
+
+    return etag_file.read_text()
+
+
+def free_disk_space(required_bytes):
+    """ Remove expanded vectorstores that are no longer held in memory until
+    /tmp has room for an archive and its expanded copy.
+    """
+
+    cached_dirs = {get_local_dir(key) for key in list(vectorstore_cache)}
+    for etag_file in pathlib.Path("/tmp").rglob("*.etag"):
+        if shutil.disk_usage("/tmp").free >= required_bytes:
+            return
+
+        local_dir = str(etag_file)[:-5]  # remove .etag
+        if local_dir in cached_dirs or local_dir in loading_dirs:
+            continue
+
+        print(f"Removing {local_dir} from disk cache")
+        etag_file.unlink()
+        shutil.rmtree(local_dir, ignore_errors=True)
+
+
+def get_vectors_prefix(vectorstore_key):
+    """ S3 prefix of the uncompressed files for an archive key, or None.
+    """
+
+    if not vectorstore_key.endswith(VECTORSTORE_ARCHIVE_SUFFIX):
+        return None
+
+    return f"vectors/{vectorstore_key[:-len(VECTORSTORE_ARCHIVE_SUFFIX)]}"
+
+
+def head_database(vectorstore_key):
+    """ Find where a vectorstore is stored, returning the prefix of its
+    uncompressed files (None for the zip archive) and the HeadObject response
+    of the object whose ETag versions it.
+    """
 
-    # Download
-    print(f"Downloading from s3://{S3_ASSETS_BUCKET_NAME}/{vectorstore_key}")
-    bucket = boto3.resource("s3").Bucket(S3_ASSETS_BUCKET_NAME)
-    bucket.download_file(vectorstore_key, local_zip)
+    prefix = get_vectors_prefix(vectorstore_key)
+    if prefix is not None:
+        try:
+            head = s3_client.head_object(Bucket=S3_ASSETS_BUCKET_NAME, Key=f"{prefix}/index.faiss")
+            return prefix, head
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NotFound"):
+                raise
 
-    # Unzip
-    print(f"Expanding {local_zip}")
-    pathlib.Path(local_dir).mkdir(exist_ok=True)
-    with zipfile.ZipFile(local_zip, "r") as zf:
-        zf.extractall(local_dir)
+    return None, s3_client.head_object(Bucket=S3_ASSETS_BUCKET_NAME, Key=vectorstore_key)
+
+
+def download_object(key, path, etag=None):
+    """ Stream an object to path, failing with PreconditionFailed if etag is
+    given and no longer matches, and return the ETag of what was written.
+    """
+
+    args = {"Bucket": S3_ASSETS_BUCKET_NAME, "Key": key}
+    if etag is not None:
+        args["IfMatch"] = etag
+
+    print(f"Downloading from s3://{S3_ASSETS_BUCKET_NAME}/{key}")
+    response = s3_client.get_object(**args)
+    with open(path, "wb") as f:
+        shutil.copyfileobj(response["Body"], f, 1024 * 1024)
+
+    return response["ETag"]
+
+
+def download_database(vectorstore_key, prefix, etag, docstore_etag=None):
+    """ Download a vectorstore into /tmp, recording its ETag.
+
+    The uncompressed files are copied as they are; an archive is expanded.
+    docstore_etag, recorded on index.faiss by the vectorization task, pins
+    the docstore to the index so a concurrent upload cannot mix versions.
+    """
+
+    local_dir = get_local_dir(vectorstore_key)
+    etag_file = pathlib.Path(f"{local_dir}.etag")
+
+    # Invalidate the previous copy before touching it
+    if etag_file.exists():
+        etag_file.unlink()
+    shutil.rmtree(local_dir, ignore_errors=True)
+    pathlib.Path(local_dir).mkdir(parents=True)
+
+    if prefix is not None:
+        if docstore_etag is not None:
+            download_object(f"{prefix}/docstore.db", f"{local_dir}/docstore.db", docstore_etag)
+        else:
+            for filename in VECTORSTORE_DOCSTORE_FILES:
+                try:
+                    download_object(f"{prefix}/{filename}", f"{local_dir}/{filename}")
+                    break
+                except ClientError as e:
+                    if e.response["Error"]["Code"] not in ("404", "NoSuchKey", "NotFound"):
+                        raise
+
+        download_object(f"{prefix}/index.faiss", f"{local_dir}/index.faiss", etag)
+    else:
+        local_zip = f"{local_dir}.zip"
+
+        # Download
+        download_object(vectorstore_key, local_zip, etag)
+
+        # Unzip
+        print(f"Expanding {local_zip}")
+        with zipfile.ZipFile(local_zip, "r") as zf:
+            zf.extractall(local_dir)
+        os.remove(local_zip)
+
+    etag_file.write_text(etag)
+
+
+def open_database(local_dir):
+    """ Load the FAISS store expanded in local_dir, returning it and its size on disk.
+    """
 
     index_search = list(pathlib.Path(local_dir).rglob("*index.faiss"))
     if len(index_search) != 1:
@@ -113,58 +317,157 @@ def load_database(vectorstore_key):
     index_dir = index_file.parent
     print(list(index_dir.rglob("*")))
 
+    # A SQLite docstore stays on disk and does not count towards memory
+    size = sum(
+        f.stat().st_size for f in index_dir.rglob("*") if f.is_file() and f.name != "docstore.db")
+
+    # Memory map the inverted lists of IVF indexes, which is how the task
+    # writes the uncompressed flat and sq8 copies; other index types (HNSW,
+    # archives of older uploads) are read into memory
+    index = faiss.read_index(str(index_file), faiss.IO_FLAG_MMAP)
+
+    docstore_file = index_dir / "docstore.db"
+    if docstore_file.exists():
+        docstore = SQLiteDocstore(str(docstore_file))
+        index_to_docstore_id = SQLiteIndexMap(docstore)
+    else:
+        with open(index_dir / "index.pkl", "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+
     print("Loading embeddings")
     embeddings = get_sagemaker_embeddings()
-    return FAISS.load_local(index_dir, embeddings=embeddings)
+    return FAISS(embeddings.embed_query, index, docstore, index_to_docstore_id), size
 
 
-def save_context(connection_id, qa_chain):
-    # Generate pickle file from the conversation history
-    with open("/tmp/chat_history.pkl", "wb") as f:
-        pickle.dump(qa_chain.memory, f)
+def load_database(vectorstore_key):
+    """ Load the database of knowledge we want to query off of.
 
-    # Generate unique identifier for this context
-    context_id = uuid.uuid4().hex
-    upload_key = f"context/{connection_id}/{context_id}-chat_history.pkl"
+    Vectorstores are kept in memory between invocations and keyed by their S3
+    ETag, so S3 is only asked for the ETag once VECTORSTORE_CACHE_TTL has passed.
+    Expanded archives are kept in /tmp next to their ETag, so a vectorstore
+    that fell out of memory is only downloaded again when it has changed.
+    Uncompressed vectorstores are preferred over archives when available.
+    """
 
-    # Upload to S3
-    bucket = boto3.resource("s3").Bucket(S3_ASSETS_BUCKET_NAME)
-    bucket.upload_file("/tmp/chat_history.pkl", upload_key)
+    now = time.time()
+
+    with vectorstore_cache_lock:
+        entry = vectorstore_cache.get(vectorstore_key)
+        if entry is not None and now - entry["checked"] < VECTORSTORE_CACHE_TTL:
+            vectorstore_cache_stats["hit"] += 1
+            print(f"Vectorstore cache hit for {vectorstore_key}: {vectorstore_cache_stats}")
+            vectorstore_cache.move_to_end(vectorstore_key)
+            return entry["vectorstore"]
+
+    prefix, head = head_database(vectorstore_key)
+    etag = head["ETag"]
+
+    # Another thread may have loaded or evicted the entry during the HEAD request
+    with vectorstore_cache_lock:
+        entry = vectorstore_cache.get(vectorstore_key)
+        if entry is not None and entry["etag"] == etag:
+            vectorstore_cache_stats["revalidate"] += 1
+            print(f"Vectorstore cache revalidated for {vectorstore_key}: {vectorstore_cache_stats}")
+            entry["checked"] = now
+            vectorstore_cache.move_to_end(vectorstore_key)
+            return entry["vectorstore"]
+
+        vectorstore_cache.pop(vectorstore_key, None)
+
+    local_dir = get_local_dir(vectorstore_key)
+    with vectorstore_cache_lock:
+        loading_dirs[local_dir] += 1
+
+    try:
+        if read_local_etag(local_dir) == etag:
+            with vectorstore_cache_lock:
+                vectorstore_cache_stats["disk"] += 1
+            print(f"Vectorstore disk cache hit for {vectorstore_key}: {vectorstore_cache_stats}")
+        else:
+            # Room for the archive and its expanded copy side by side
+            with vectorstore_cache_lock:
+                vectorstore_cache_stats["miss"] += 1
+                free_disk_space(2 * head["ContentLength"])
+            print(f"Vectorstore cache miss for {vectorstore_key}: {vectorstore_cache_stats}")
+            download_database(vectorstore_key, prefix, etag, head.get("Metadata", {}).get("docstore-etag"))
+
+        vectorstore, size = open_database(local_dir)
+
+        budget = get_vectorstore_cache_budget()
+        with vectorstore_cache_lock:
+            evict_vectorstores(budget - size)
+            if size <= budget:
+                vectorstore_cache[vectorstore_key] = {
+                    "vectorstore": vectorstore,
+                    "etag": etag,
+                    "size": size,
+                    "checked": now
+                }
+    finally:
+        with vectorstore_cache_lock:
+            loading_dirs[local_dir] -= 1
+            if not loading_dirs[local_dir]:
+                del loading_dirs[local_dir]
+
+    return vectorstore
+
+
+def make_memory(turns=()):
+    """ Build the conversation memory from (question, answer) turns, oldest first.
+    """
 
-    # Save pointer to context
+    memory = ConversationBufferWindowMemory(
+        memory_key="chat_history", return_messages=True, k=CHAT_HISTORY_WINDOW
+    )
+    for question, answer in turns:
+        memory.chat_memory.add_user_message(question)
+        memory.chat_memory.add_ai_message(answer)
+
+    return memory
+
+
+def save_context(connection_id, question, answer):
+    # Append this turn only; previous turns are never rewritten.
+    # CHAT sorts just below CONFIG so load_state can read both in one Query.
     table = boto3.resource("dynamodb").Table(CONTEXT_TABLE_NAME)
     table.put_item(
         Item={
             "id": f"CONNECTION#{connection_id}",
-            "connection_id": f"CONNECTION#{connection_id}#CONTEXT",
-            "bucket_name": S3_ASSETS_BUCKET_NAME,
-            "key": upload_key
+            "connection_id": f"CONNECTION#{connection_id}#CHAT#{time.time_ns():020d}",
+            "question": question,
+            "answer": answer
         }
     )
 
+
 def load_context(connection_id):
-    # Retrieve pointer to existing context
+    # Read back the most recent turns only
     table = boto3.resource("dynamodb").Table(CONTEXT_TABLE_NAME)
-    response = table.get_item(
-        Key={
-            "id": f"CONNECTION#{connection_id}",
-            "connection_id": f"CONNECTION#{connection_id}#CONTEXT",
-        },
+    response = table.query(
+        KeyConditionExpression=Key("id").eq(f"CONNECTION#{connection_id}")
+        & Key("connection_id").begins_with(f"CONNECTION#{connection_id}#CHAT#"),
+        ScanIndexForward=False,
+        Limit=CHAT_HISTORY_WINDOW,
         ConsistentRead=True
     )
 
-    if not "Item" in response:
+    items = response["Items"]
+    if not items:
         print("No previous context found.")
         return None
 
-    item = response["Item"]
+    turns = [(item["question"], item["answer"]) for item in reversed(items)]
+    return make_memory(turns)
 
-    # Download
-    bucket = boto3.resource("s3").Bucket(item["bucket_name"])
-    bucket.download_file(item["key"], "/tmp/chat_history.pkl")
 
-    with open("/tmp/chat_history.pkl", "rb") as f:
-        return pickle.load(f)
+def from_dynamodb(value):
+    """ Convert the Decimal numbers DynamoDB returns back into plain JSON types.
+    """
+
+    def convert(number):
+        return int(number) if number == number.to_integral_value() else float(number)
+
+    return json.loads(json.dumps(value, default=convert))
 
 
 def save_config(connection_id, config_dict):
@@ -173,7 +476,8 @@ def save_config(connection_id, config_dict):
         Item={
             "id": f"CONNECTION#{connection_id}",
             "connection_id": f"CONNECTION#{connection_id}#CONFIG",
-            "config": config_dict
+            # DynamoDB stores numbers as Decimal, not float
+            "config": json.loads(json.dumps(config_dict), parse_float=Decimal)
         }
     )
 
@@ -189,15 +493,134 @@ def load_config(connection_id):
     )
 
     if "Item" in response:
-        return response["Item"]["config"]
+        return from_dynamodb(response["Item"]["config"])
 
     return None
 
 
-def make_chain(connection_id, llm_type, vectorstore_key, bot_name, model_id, memory=None):
-    """ Create a Q/A chain.
+def load_state(connection_id):
+    """ Load the config and the most recent turns of a conversation with a single Query.
+
+    Sorted descending, the CONFIG item comes first followed by the newest turns.
+    """
+
+    partition = f"CONNECTION#{connection_id}"
+    table = boto3.resource("dynamodb").Table(CONTEXT_TABLE_NAME)
+    response = table.query(
+        KeyConditionExpression=Key("id").eq(partition)
+        & Key("connection_id").between(f"{partition}#CHAT#", f"{partition}#CONFIG"),
+        ScanIndexForward=False,
+        Limit=CHAT_HISTORY_WINDOW + 1,
+        ConsistentRead=True
+    )
+
+    config = None
+    turns = []
+    for item in response["Items"]:
+        if item["connection_id"] == f"{partition}#CONFIG":
+            config = from_dynamodb(item["config"])
+        else:
+            turns.append((item["question"], item["answer"]))
+
+    if not turns:
+        print("No previous context found.")
+        return config, None
+
+    return config, make_memory(reversed(turns))
+
+
+def get_retrieval_config(retrieval=None):
+    """ Retrieval settings with defaults filled in and DynamoDB numbers converted.
+    """
+
+    retrieval = {**DEFAULT_RETRIEVAL_CONFIG, **(retrieval or {})}
+
+    def optional(value, cast):
+        return None if value is None else cast(value)
+
+    return {
+        "k": int(retrieval["k"]),
+        "fetch_k": int(retrieval["fetch_k"]),
+        "mmr_lambda": optional(retrieval["mmr_lambda"], float),
+        "score_threshold": optional(retrieval["score_threshold"], float),
+        "max_context_tokens": optional(retrieval["max_context_tokens"], int)
+    }
+
+
+def create_retriever(vectorstore, retrieval):
+    search_kwargs = {"k": retrieval["k"]}
+
+    if retrieval["mmr_lambda"] is not None:
+        search_type = "mmr"
+        search_kwargs["fetch_k"] = retrieval["fetch_k"]
+        search_kwargs["lambda_mult"] = retrieval["mmr_lambda"]
+    elif retrieval["score_threshold"] is not None:
+        search_type = "similarity_score_threshold"
+        search_kwargs["score_threshold"] = retrieval["score_threshold"]
+    else:
+        search_type = "similarity"
+
+    return vectorstore.as_retriever(search_type=search_type, search_kwargs=search_kwargs)
+
+
+def get_retriever(vectorstore_key, retrieval):
+    """ Retriever over a vectorstore, reused for as long as the vectorstore stays cached.
+    """
+
+    vectorstore = load_database(vectorstore_key)
+
+    with vectorstore_cache_lock:
+        entry = vectorstore_cache.get(vectorstore_key)
+        if entry is None or entry["vectorstore"] is not vectorstore:
+            return create_retriever(vectorstore, retrieval)
+
+        retrievers = entry.setdefault("retrievers", {})
+        retriever_key = tuple(sorted(retrieval.items()))
+        if retriever_key not in retrievers:
+            retrievers[retriever_key] = create_retriever(vectorstore, retrieval)
+
+        return retrievers[retriever_key]
+
+
+def get_corpus_vectorstore_keys():
+    """ Archive keys of the current corpus index shards, re-read every VECTORSTORE_CACHE_TTL.
+    """
+
+    now = time.time()
+    if corpus_cache["keys"] is not None and now - corpus_cache["checked"] < VECTORSTORE_CACHE_TTL:
+        return corpus_cache["keys"]
+
+    response = s3_client.get_object(Bucket=S3_ASSETS_BUCKET_NAME, Key=CORPUS_MANIFEST_KEY)
+    manifest = json.loads(response["Body"].read().decode("utf-8"))
+
+    corpus_cache["keys"] = [shard["key"] for shard in manifest["shards"].values()]
+    corpus_cache["checked"] = now
+    return corpus_cache["keys"]
+
+
+def get_federated_retriever(vectorstore_keys, retrieval):
+    """ Retriever that searches several vectorstores in parallel and merges by score.
+    """
+
+    return FederatedRetriever(
+        vectorstore_keys=list(vectorstore_keys),
+        load_vectorstore=load_database,
+        k=retrieval["k"],
+        fetch_k=retrieval["fetch_k"],
+        mmr_lambda=retrieval["mmr_lambda"],
+        score_threshold=retrieval["score_threshold"],
+        max_workers=FEDERATED_SEARCH_WORKERS
+    )
+
+
+def get_chains(bot_name, model_id):
+    """ Create the question and document chains for a bot, or reuse the cached ones.
     """
 
+    cache_key = (model_id, bot_name)
+    if cache_key in chain_cache:
+        return chain_cache[cache_key]
+
     manager_q = CallbackManager([MyStdOutCallbackHandler()])
     manager = CallbackManager([MyStdOutCallbackHandler()])
     modelId = model_id
@@ -205,7 +628,9 @@ def make_chain(connection_id, llm_type, vectorstore_key, bot_name, model_id, mem
 
     llm_q = Bedrock(
         callback_manager=manager_q, model_id= modelId, model_kwargs=question_llm_model_args)
-    llm = Bedrock(callback_manager=manager, model_id= modelId, model_kwargs=qa_llm_model_args)
+    llm = Bedrock(
+        callback_manager=manager, model_id= modelId, model_kwargs=qa_llm_model_args,
+        streaming=BEDROCK_STREAMING and not modelId.startswith("ai21"))
 
     if AWS_INTERNAL.upper() == "TRUE":
         bedrock_client = get_bedrock_client()
@@ -216,27 +641,80 @@ def make_chain(connection_id, llm_type, vectorstore_key, bot_name, model_id, mem
 
     print("Using LLM:", llm)
 
-    question_chain = LLMChain(llm=llm_q, prompt=get_question_prompt(modelId))
+    question_chain = QuestionChain(llm=llm_q, prompt=get_question_prompt(modelId))
 
     # Use a document chain with a customized prompt
     document_chain = load_qa_chain(
         llm, chain_type="stuff", prompt=get_document_prompt(bot_name, modelId))
 
+    chain_cache[cache_key] = (question_chain, document_chain)
+    return question_chain, document_chain
+
+
+def make_chain(connection_id, llm_type, vectorstore_key, bot_name, model_id, memory=None, retrieval=None,
+               vectorstore_keys=None):
+    """ Create a Q/A chain.
+
+    Only the conversation memory is bound per call; the LLMs, prompts and
+    retriever come from the caches above. When vectorstore_keys is given the
+    chain searches all of those vectorstores instead of vectorstore_key.
+    """
+
+    question_chain, document_chain = get_chains(bot_name, model_id)
+    retrieval = get_retrieval_config(retrieval)
+
     if memory is None:
-        memory = ConversationBufferMemory(
-            memory_key="chat_history", return_messages=True
-        )
+        memory = make_memory()
+
+    if vectorstore_keys:
+        retriever = get_federated_retriever(vectorstore_keys, retrieval)
+    else:
+        retriever = get_retriever(vectorstore_key, retrieval)
 
-    qa_chain = ConversationalRetrievalChain(
-        retriever=load_database(vectorstore_key).as_retriever(),
+    qa_chain = BudgetedRetrievalChain(
+        retriever=retriever,
         combine_docs_chain=document_chain,
         question_generator=question_chain,
-        memory=memory
+        memory=memory,
+        max_context_tokens=retrieval["max_context_tokens"]
     )
 
     return qa_chain
 
 
+def get_answer_scope(vectorstore_key, bot_name, model_id, retrieval):
+    """ Answers are only shared between conversations that retrieve the same way.
+    """
+
+    return (vectorstore_key, model_id, bot_name, tuple(sorted(get_retrieval_config(retrieval).items())))
+
+
+def get_cached_answer(vectorstore_key, bot_name, model_id, question, retrieval=None):
+    """ Answer given earlier to a similar first-turn question, or None.
+
+    Only cached vectorstores take part, so stored answers are always tied to
+    the ETag the vectorstore was loaded from.
+    """
+
+    with vectorstore_cache_lock:
+        entry = vectorstore_cache.get(vectorstore_key)
+    if entry is None:
+        return None
+
+    vector = get_sagemaker_embeddings().embed_query(question)
+    return lookup_answer(get_answer_scope(vectorstore_key, bot_name, model_id, retrieval), entry["etag"], vector)
+
+
+def cache_answer(vectorstore_key, bot_name, model_id, question, answer, retrieval=None):
+    with vectorstore_cache_lock:
+        entry = vectorstore_cache.get(vectorstore_key)
+    if entry is None:
+        return
+
+    vector = get_sagemaker_embeddings().embed_query(question)
+    store_answer(get_answer_scope(vectorstore_key, bot_name, model_id, retrieval), entry["etag"], vector, answer)
+
+
 def get_bedrock_client():
     bedrock_session = boto3.Session(
             aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
@@ -0,0 +1,114 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Question Rephrase Chain
+
+import re
+from typing import Any, Dict, List, Optional
+from langchain.chains import ConversationalRetrievalChain
+from langchain.chains.llm import LLMChain
+from langchain.callbacks.manager import CallbackManagerForChainRun
+from langchain.schema import Document
+
+# Words that usually point back at something said earlier in the conversation
+FOLLOW_UP_WORDS = {
+    "it", "its", "they", "them", "their", "theirs", "this", "that", "these",
+    "those", "he", "him", "his", "she", "her", "hers", "there", "former",
+    "latter", "above", "previous", "same", "else", "more", "again", "also",
+    "here", "then", "such", "mentioned", "earlier",
+}
+
+# Words that select among things listed earlier ("which one", "the second option")
+SELECTION_WORDS = {
+    "which", "one", "ones", "first", "second", "third", "fourth", "fifth",
+    "last", "next", "option", "options", "choice", "choices", "other",
+    "others", "another", "either", "neither", "both", "each",
+}
+
+# Openings that only make sense as a continuation
+FOLLOW_UP_OPENINGS = ("and ", "but ", "or ", "so ", "what about", "how about", "why not")
+
+# Questions shorter than this are usually elliptical ("why?", "how much
+# does it cost?"). Skipping the rephrase on a follow up silently degrades
+# retrieval, so the heuristic only fires for long, self contained questions.
+MIN_STANDALONE_WORDS = 7
+
+# Rough number of characters per token for English text
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def is_standalone_question(question):
+    """ Guess whether a question can be answered without the chat history.
+    """
+
+    text = question.strip().lower()
+    words = re.findall(r"[a-z']+", text)
+
+    if len(words) < MIN_STANDALONE_WORDS:
+        return False
+
+    if text.startswith(FOLLOW_UP_OPENINGS):
+        return False
+
+    return not any(word in FOLLOW_UP_WORDS or word in SELECTION_WORDS for word in words)
+
+
+class QuestionChain(LLMChain):
+    """ Question rephrasing chain that skips the LLM call when there is no
+    chat history or the follow up question already stands on its own.
+    """
+
+    def _call(
+        self,
+        inputs: Dict[str, Any],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Dict[str, str]:
+        question = inputs["question"]
+
+        if not inputs.get("chat_history") or is_standalone_question(question):
+            print(f"Skipping question rephrase for: {question}")
+            return {self.output_key: question}
+
+        return super()._call(inputs, run_manager=run_manager)
+
+
+class BudgetedRetrievalChain(ConversationalRetrievalChain):
+    """ Conversational retrieval chain that drops the lowest ranked documents
+    once the context would exceed max_context_tokens.
+    """
+
+    max_context_tokens: Optional[int] = None
+
+    def _reduce_tokens_below_limit(self, docs: List[Document]) -> List[Document]:
+        if self.max_context_tokens is None:
+            return super()._reduce_tokens_below_limit(docs)
+
+        kept = []
+        tokens = 0
+        for doc in docs:
+            tokens += estimate_tokens(doc.page_content)
+            # Always keep the best match, even if it alone is over budget
+            if kept and tokens > self.max_context_tokens:
+                break
+            kept.append(doc)
+
+        if len(kept) < len(docs):
+            print(f"Trimmed context from {len(docs)} to {len(kept)} documents")
+
+        return kept
@@ -0,0 +1,75 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# SQLite Docstore
+
+import json
+import pathlib
+import sqlite3
+import threading
+from collections.abc import Mapping
+from typing import Union
+from langchain.docstore.base import Docstore
+from langchain.schema import Document
+
+
+class SQLiteDocstore(Docstore):
+    """ Read-only docstore backed by the docstore.db written by the vectorization
+    task. Chunks are read by id when a search returns them, so loading a
+    vectorstore no longer unpickles every chunk.
+    """
+
+    def __init__(self, path: str):
+        # as_uri percent-encodes the path, so names with #, ? or % open the right file
+        uri = pathlib.Path(path).resolve().as_uri()
+        self.connection = sqlite3.connect(
+            f"{uri}?mode=ro&immutable=1", uri=True, check_same_thread=False
+        )
+        # The federated retriever searches from several threads
+        self.lock = threading.Lock()
+
+    def query(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def search(self, search: str) -> Union[str, Document]:
+        rows = self.query("SELECT page_content, metadata FROM documents WHERE id = ?", (search,))
+        if not rows:
+            return f"ID {search} not found."
+
+        page_content, metadata = rows[0]
+        return Document(page_content=page_content, metadata=json.loads(metadata))
+
+
+class SQLiteIndexMap(Mapping):
+    """ FAISS position -> docstore id, read lazily from the same database.
+    """
+
+    def __init__(self, docstore: SQLiteDocstore):
+        self.docstore = docstore
+
+    def __getitem__(self, position):
+        rows = self.docstore.query("SELECT id FROM ids WHERE position = ?", (int(position),))
+        if not rows:
+            raise KeyError(position)
+
+        return rows[0][0]
+
+    def __len__(self):
+        return self.docstore.query("SELECT COUNT(*) FROM ids")[0][0]
+
+    def __iter__(self):
+        rows = self.docstore.query("SELECT position FROM ids ORDER BY position")
+        return (row[0] for row in rows)
@@ -27,14 +27,31 @@
 # --
 
 from typing import Dict, List
+from array import array
+from collections import OrderedDict
+import hashlib
 import json
 import os
+import re
 
+import boto3
 from langchain.embeddings import SagemakerEndpointEmbeddings
 from langchain.embeddings.sagemaker_endpoint import EmbeddingsContentHandler
 
 AWS_REGION = os.environ["AWS_REGION"]
 EMBEDDINGS_SAGEMAKER_ENDPOINT = os.environ["EMBEDDINGS_SAGEMAKER_ENDPOINT"]
+# Number of query vectors kept in memory
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "1024"))
+# Optional DynamoDB table shared by all execution environments
+EMBEDDING_CACHE_TABLE_NAME = os.environ.get("EMBEDDING_CACHE_TABLE_NAME")
+
+# Normalized query text -> vector, least recently used first
+embedding_cache = OrderedDict()
+
+# How embed_query was served since this execution environment started
+embedding_cache_stats = {"memory": 0, "table": 0, "endpoint": 0}
+
+sagemaker_embeddings = None
 
 
 class E5_ContentHandler(EmbeddingsContentHandler):
@@ -50,9 +67,82 @@ class E5_ContentHandler(EmbeddingsContentHandler):
         return response_json["vectors"]
 
 
+def normalize_query(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def get_table_key(normalized: str) -> Dict[str, str]:
+    digest = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+    return {
+        "id": f"EMBEDDING#{EMBEDDINGS_SAGEMAKER_ENDPOINT}#{digest}",
+        "connection_id": "EMBEDDING",
+    }
+
+
+class CachedSagemakerEndpointEmbeddings(SagemakerEndpointEmbeddings):
+    """SageMaker embeddings that remember query vectors by normalized text,
+    first in memory and then, if configured, in DynamoDB."""
+
+    def embed_query(self, text: str) -> List[float]:
+        normalized = normalize_query(text)
+
+        if normalized in embedding_cache:
+            embedding_cache.move_to_end(normalized)
+            self.record("memory")
+            return embedding_cache[normalized]
+
+        vector = self.read_table(normalized)
+        if vector is not None:
+            self.record("table")
+        else:
+            vector = super().embed_query(text)
+            self.record("endpoint")
+            self.write_table(normalized, vector)
+
+        embedding_cache[normalized] = vector
+        while len(embedding_cache) > EMBEDDING_CACHE_SIZE:
+            embedding_cache.popitem(last=False)
+
+        return vector
+
+    def record(self, source: str) -> None:
+        embedding_cache_stats[source] += 1
+        total = sum(embedding_cache_stats.values())
+        hits = total - embedding_cache_stats["endpoint"]
+        print(f"Query embedding from {source}, hit rate {hits / total:.2f}: {embedding_cache_stats}")
+
+    def read_table(self, normalized: str):
+        if not EMBEDDING_CACHE_TABLE_NAME:
+            return None
+
+        table = boto3.resource("dynamodb").Table(EMBEDDING_CACHE_TABLE_NAME)
+        response = table.get_item(Key=get_table_key(normalized))
+        if "Item" not in response:
+            return None
+
+        return array("f", response["Item"]["vector"].value).tolist()
+
+    def write_table(self, normalized: str, vector: List[float]) -> None:
+        if not EMBEDDING_CACHE_TABLE_NAME:
+            return
+
+        table = boto3.resource("dynamodb").Table(EMBEDDING_CACHE_TABLE_NAME)
+        table.put_item(
+            Item={
+                **get_table_key(normalized),
+                "vector": array("f", vector).tobytes()
+            }
+        )
+
+
 def get_sagemaker_embeddings():
-    return SagemakerEndpointEmbeddings(
-        endpoint_name=EMBEDDINGS_SAGEMAKER_ENDPOINT,
-        region_name=AWS_REGION,
-        content_handler=E5_ContentHandler()
-    )
+    global sagemaker_embeddings
+
+    if sagemaker_embeddings is None:
+        sagemaker_embeddings = CachedSagemakerEndpointEmbeddings(
+            endpoint_name=EMBEDDINGS_SAGEMAKER_ENDPOINT,
+            region_name=AWS_REGION,
+            content_handler=E5_ContentHandler()
+        )
+
+    return sagemaker_embeddings
@@ -27,8 +27,10 @@
 # --
 
 from langchain.callbacks import StdOutCallbackHandler
+from langchain.callbacks.base import BaseCallbackHandler
 from langchain.schema import LLMResult
-from typing import Any, Dict, List
+import time
+from typing import Any, Callable, Dict, List
 
 class MyStdOutQuestionCallbackHandler(StdOutCallbackHandler):
     def on_llm_start(
@@ -42,11 +44,30 @@ class MyStdOutQuestionCallbackHandler(StdOutCallbackHandler):
 
 
 class MyStdOutCallbackHandler(StdOutCallbackHandler):
+    start_time = None
+
     def on_llm_start(
         self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
     ) -> None:
         """Print out the prompts."""
+        self.start_time = time.time()
         print(f"QA prompts={prompts}")
 
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        """Print the time to first token of a streamed answer."""
+        if self.start_time is not None:
+            print(f"QA first token after {time.time() - self.start_time:.2f}s")
+            self.start_time = None
+
     def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
         print(f"QA llm_output={response.llm_output}")
+
+
+class TokenStreamCallbackHandler(BaseCallbackHandler):
+    """Pass each streamed answer token to write, e.g. a streamed HTTP response."""
+
+    def __init__(self, write: Callable[[str], None]):
+        self.write = write
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.write(token)
@@ -42,31 +42,56 @@ def lambda_handler(event, context):
     body = event.get("body", "{}")
     body = json.loads(body)
 
+    return {
+        "statusCode": 200,
+        "body": json.dumps(answer_question(body)),
+      
+    }
+
+
+def answer_question(body, callbacks=None):
+    """ Answer the question in a request body and return the response body.
+
+    callbacks are attached to this call only; the streaming server uses them
+    to receive the answer tokens as Bedrock generates them.
+    """
+
     conversation_id = body.get("conversation_id")
     if not conversation_id:
         # Initialize new context
         llm_type = body.get("llm_type", "amazon_api_gateway")
         vectorstore_key = body.get("vectorstore_key")
+        vectorstore_keys = body.get("vectorstore_keys", [])
+        corpus = body.get("corpus", False)
         bot_name = body.get("bot_name", "Guru")
         model_id = body.get("model_id")
+        retrieval = body.get("retrieval", {})
         conversation_id = uuid.uuid4().hex
 
         config = {
             "llm_type": llm_type,
             "vectorstore_key": vectorstore_key,
+            "vectorstore_keys": vectorstore_keys,
+            "corpus": corpus,
             "bot_name": bot_name,
-            "model_id": model_id
+            "model_id": model_id,
+            "retrieval": retrieval
         }
 
         bot.save_config(conversation_id, config)
         print("Saved config:", config)
+
+        # A new conversation has no context yet
+        memory = None
     else:
-        # Load context from previous conversation
-        config = bot.load_config(conversation_id)
+        # Load config and context from previous conversation
+        config, memory = bot.load_state(conversation_id)
         print("Loaded config:", config)
 
-    # Load up existing context
-    memory = bot.load_context(conversation_id)
+    # Search the whole corpus index, several listed vectorstores or just one
+    vectorstore_keys = config.get("vectorstore_keys")
+    if config.get("corpus"):
+        vectorstore_keys = bot.get_corpus_vectorstore_keys()
 
     # Generate answer
     question = body["question"]
@@ -76,11 +101,28 @@ def lambda_handler(event, context):
         config["vectorstore_key"],
         config["bot_name"],
         config["model_id"],
-        memory=memory
+        memory=memory,
+        retrieval=config.get("retrieval"),
+        vectorstore_keys=vectorstore_keys
     )
     
-    qa_result = qa_chain({"question": question })
-    answer = qa_result["answer"].strip()
+    # First turns against the same vectorstore are often answered identically
+    answer = None
+    if memory is None and not vectorstore_keys:
+        answer = bot.get_cached_answer(
+            config["vectorstore_key"], config["bot_name"], config["model_id"], question,
+            retrieval=config.get("retrieval"))
+
+    if answer is None:
+        qa_result = qa_chain({"question": question }, callbacks=callbacks)
+        answer = qa_result["answer"].strip()
+
+        if memory is None and not vectorstore_keys:
+            bot.cache_answer(
+                config["vectorstore_key"], config["bot_name"], config["model_id"], question, answer,
+                retrieval=config.get("retrieval"))
+    else:
+        print("Answered from cache")
     
     body = {
         "answer":  answer,
@@ -88,10 +130,6 @@ def lambda_handler(event, context):
         "config": config
     }
 
-    bot.save_context(conversation_id, qa_chain)
+    bot.save_context(conversation_id, question, answer)
 
-    return {
-        "statusCode": 200,
-        "body": json.dumps(body),
-      
-    }
\ No newline at end of file
+    return body
\ No newline at end of file
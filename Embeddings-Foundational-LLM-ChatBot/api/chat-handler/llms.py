@@ -27,7 +27,7 @@
 # --
 
 import json
-from typing import Any, Dict, List, Mapping, Optional
+from typing import Any, Dict, Iterator, List, Mapping, Optional
 from langchain.llms.base import LLM
 from langchain.callbacks.manager import CallbackManagerForLLMRun
 from langchain.llms.utils import enforce_stop_tokens
@@ -72,6 +72,22 @@ class LLMInputOutputAdapter:
         else:
             return response_body.get("results")[0].get("outputText")
 
+    @classmethod
+    def prepare_output_stream(cls, provider: str, response: Any) -> Iterator[str]:
+        if provider == "ai21":
+            raise ValueError("Streaming is not supported for ai21 models")
+
+        for event in response.get("body"):
+            chunk = event.get("chunk")
+            if not chunk:
+                continue
+
+            chunk_body = json.loads(chunk.get("bytes").decode())
+            if provider == "anthropic":
+                yield chunk_body.get("completion", "")
+            else:
+                yield chunk_body.get("outputText", "")
+
 
 class Bedrock(LLM):
     """Bedrock models.
@@ -125,6 +141,10 @@ class Bedrock(LLM):
     endpoint_url: Optional[str] = None
     """Needed if you don't want to default to us-east-1 endpoint"""
 
+    streaming: bool = False
+    """Whether to stream the completion with invoke_model_with_response_stream.
+    Each chunk is passed to the callback manager as it arrives."""
+
     class Config:
         """Configuration for this pydantic object."""
 
@@ -153,7 +173,7 @@ class Bedrock(LLM):
             if values["endpoint_url"]:
                 client_params["endpoint_url"] = values["endpoint_url"]
 
-            values["client"] = session.client("bedrock", **client_params)
+            values["client"] = session.client("bedrock-runtime", **client_params)
 
         except ImportError:
             raise ModuleNotFoundError(
@@ -212,6 +232,9 @@ class Bedrock(LLM):
         accept = "application/json"
         contentType = "application/json"
 
+        if self.streaming:
+            return self._call_stream(provider, body, stop, run_manager)
+
         try:
             response = self.client.invoke_model(
                 body=body, modelId=self.model_id, accept=accept, contentType=contentType
@@ -225,3 +248,43 @@ class Bedrock(LLM):
             text = enforce_stop_tokens(text, stop)
 
         return text
+
+    def _call_stream(
+        self,
+        provider: str,
+        body: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+    ) -> str:
+        """Call out to Bedrock with a response stream.
+
+        Chunks are handed to run_manager as they arrive, and the stream is
+        abandoned as soon as a stop word has been generated.
+
+        Returns:
+            The string generated by the model.
+        """
+        text = ""
+
+        try:
+            response = self.client.invoke_model_with_response_stream(
+                body=body,
+                modelId=self.model_id,
+                accept="application/json",
+                contentType="application/json",
+            )
+
+            for chunk in LLMInputOutputAdapter.prepare_output_stream(provider, response):
+                text += chunk
+                if run_manager:
+                    run_manager.on_llm_new_token(chunk)
+                if stop is not None and any(word in text for word in stop):
+                    break
+
+        except Exception as e:
+            raise ValueError(f"Error raised by bedrock service: {e}")
+
+        if stop is not None:
+            text = enforce_stop_tokens(text, stop)
+
+        return text
@@ -0,0 +1,94 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Federated Retriever
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain.schema import BaseRetriever, Document
+from embeddings import get_sagemaker_embeddings
+
+
+class FederatedRetriever(BaseRetriever):
+    """ Retriever over many FAISS vectorstores built with the same embeddings.
+
+    The query is embedded once, every vectorstore is loaded and searched on a
+    thread pool, and the k closest documents overall are returned. Scores are
+    FAISS L2 distances, so lower is better and they compare across stores.
+
+    The conversation's retrieval settings apply per store: with mmr_lambda each
+    store contributes a diverse selection out of its fetch_k nearest chunks, and
+    score_threshold drops chunks whose relevance score falls below it.
+    """
+
+    vectorstore_keys: List[str]
+    load_vectorstore: Callable[[str], Any]
+    k: int = 4
+    fetch_k: int = 20
+    mmr_lambda: Optional[float] = None
+    score_threshold: Optional[float] = None
+    max_workers: int = 8
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def search(self, vectorstore_key: str, vector: List[float]):
+        vectorstore = self.load_vectorstore(vectorstore_key)
+        if self.mmr_lambda is not None:
+            results = vectorstore.max_marginal_relevance_search_with_score_by_vector(
+                vector, k=self.k, fetch_k=self.fetch_k, lambda_mult=self.mmr_lambda
+            )
+        else:
+            results = vectorstore.similarity_search_with_score_by_vector(vector, k=self.k)
+
+        if self.score_threshold is not None:
+            # The same distance to relevance conversion as the single store retriever
+            relevance = vectorstore._select_relevance_score_fn()
+            results = [
+                (doc, score) for doc, score in results if relevance(score) >= self.score_threshold
+            ]
+
+        for doc, _ in results:
+            doc.metadata.setdefault("vectorstore_key", vectorstore_key)
+        return results
+
+    def search_all(self, query: str) -> List[Document]:
+        vector = get_sagemaker_embeddings().embed_query(query)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            searches = executor.map(
+                lambda key: self.search(key, vector), self.vectorstore_keys
+            )
+            results = [result for found in searches for result in found]
+
+        results.sort(key=lambda result: result[1])
+        return [doc for doc, _ in results[: self.k]]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return self.search_all(query)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        # The searches block on S3 and FAISS, so they run off the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.search_all, query)
@@ -0,0 +1,5 @@
+#!/bin/bash
+# Started by the Lambda Web Adapter (AWS_LAMBDA_EXEC_WRAPPER=/opt/bootstrap),
+# which forwards function URL requests to server.py and streams its responses.
+export PYTHONPATH="/opt/python:${LAMBDA_TASK_ROOT}:${PYTHONPATH}"
+exec python3 "${LAMBDA_TASK_ROOT}/server.py"
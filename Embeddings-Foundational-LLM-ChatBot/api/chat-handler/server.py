@@ -0,0 +1,86 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# HTTP front end of the chat handler, run by the Lambda Web Adapter so the
+# function URL can stream the answer (RESPONSE_STREAM invoke mode).
+#
+# POST / takes the same JSON body as lambda_function.lambda_handler. With
+# "stream": true the response is newline delimited JSON: {"token": ...} lines
+# while the answer is generated, then the full response body as the last line.
+
+import json
+import os
+import traceback
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import lambda_function
+from handlers import TokenStreamCallbackHandler
+
+PORT = int(os.environ.get("PORT", "8080"))
+
+
+class ChatRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        # Readiness check of the Lambda Web Adapter
+        self.send_json(200, {"status": "ok"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", "0"))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        print(body)
+
+        if not body.get("stream"):
+            try:
+                self.send_json(200, lambda_function.answer_question(body))
+            except Exception as e:
+                traceback.print_exc()
+                self.send_json(500, {"error": str(e)})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def write_line(value):
+            self.write_chunk(json.dumps(value) + "\n")
+
+        # Headers are already sent, so a failure is reported as the last line
+        try:
+            callback = TokenStreamCallbackHandler(lambda token: write_line({"token": token}))
+            write_line(lambda_function.answer_question(body, callbacks=[callback]))
+        except Exception as e:
+            traceback.print_exc()
+            write_line({"error": str(e)})
+        self.write_chunk("")
+
+    def send_json(self, status, value):
+        data = json.dumps(value).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+if __name__ == "__main__":
+    HTTPServer(("127.0.0.1", PORT), ChatRequestHandler).serve_forever()
@@ -0,0 +1,85 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Fails the pipeline execution of an embedding task that stopped without reporting back
+
+import os
+import json
+import boto3
+import logging
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+client = boto3.client('stepfunctions')
+dynamodb = boto3.resource('dynamodb')
+
+def get_container_environment(detail, container_name):
+    for override in detail.get('overrides', {}).get('containerOverrides', []):
+        if override.get('name') == container_name:
+            return {variable['name']: variable['value'] for variable in override.get('environment', [])}
+    return {}
+
+def lambda_handler(event, context):
+    """Called by EventBridge when an embedding task stops. A task that ran its
+    script exits with 0 after sending its own result; any other stop (out of
+    memory, image pull or capacity errors, the task being stopped) would leave
+    the execution waiting on its token until the step times out."""
+
+    CONTAINER_NAME = os.environ['CONTAINER_NAME']
+    detail = event['detail']
+
+    container = next((c for c in detail.get('containers', []) if c.get('name') == CONTAINER_NAME), {})
+    exit_code = container.get('exitCode')
+    if exit_code == 0:
+        return {'statusCode': 200, 'message': "Task exited normally."}
+
+    # The token and the document are passed to the task as environment overrides
+    environment = get_container_environment(detail, CONTAINER_NAME)
+    task_token = environment.get('TASK_TOKEN')
+    if not task_token:
+        return {'statusCode': 200, 'message': "Task has no pipeline execution waiting on it."}
+
+    cause = {
+        'taskArn': detail.get('taskArn'),
+        'stopCode': detail.get('stopCode'),
+        'stoppedReason': detail.get('stoppedReason'),
+        'exitCode': exit_code,
+        'containerReason': container.get('reason'),
+    }
+    logger.error(f"Embedding task stopped: {cause}")
+
+    try:
+        client.send_task_failure(
+            taskToken=task_token,
+            error='EmbeddingTaskStopped',
+            cause=json.dumps(cause)
+        )
+    except ClientError as e:
+        # The task already reported back, or the execution has ended
+        if e.response['Error']['Code'] not in ('TaskTimedOut', 'TaskDoesNotExist', 'InvalidToken'):
+            raise
+        logger.info(f"Execution no longer waiting on task {detail.get('taskArn')}: {str(e)}")
+        return {'statusCode': 200, 'message': "Execution was no longer waiting."}
+
+    # The task never got to mark the document itself
+    dynamodb.Table(environment['DYNAMODB_TABLE_NAME']).update_item(
+        Key={'id': environment['DOCUMENT_ID']},
+        UpdateExpression="SET document_status = :status",
+        ExpressionAttributeValues={':status': "Failed"}
+    )
+
+    return {'statusCode': 200, 'message': "Pipeline execution failed."}
@@ -30,8 +30,11 @@ import boto3
 import os
 import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import unquote_plus
 from botocore.exceptions import ClientError
+from langchain.docstore.document import Document
 from langchain.document_loaders import AmazonTextractPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
@@ -43,6 +46,15 @@ s3 = boto3.client('s3')
 dynamodb = boto3.resource('dynamodb')
 textract_client = boto3.client('textract')
 
+# File types extracted page by page with the asynchronous Textract API
+STREAMING_EXTENSIONS = ("pdf", "tif", "tiff")
+STREAMING_EXTRACTION = os.environ.get("STREAMING_EXTRACTION", "True").upper() == "TRUE"
+# Chunks per JSON Lines shard written to the temporary bucket
+JSONL_SHARD_SIZE = int(os.environ.get("JSONL_SHARD_SIZE", "1000"))
+TEXTRACT_POLL_SECONDS = 5
+# Records extracted in parallel within one invocation
+EXTRACTION_CONCURRENCY = int(os.environ.get("EXTRACTION_CONCURRENCY", "4"))
+
 def mark_document_as_failed(document_id, dynamodb_table_name):
     table = dynamodb.Table(dynamodb_table_name)
     response = table.update_item(
@@ -56,8 +68,179 @@ def upload_to_s3(bucket_name, document, document_name):
     key = f"documents/{document_name}.json"
     s3.put_object(Bucket=bucket_name, Key=key, Body=document)
 
+def start_textract_job(client, bucket, key):
+    """Start an asynchronous Textract text detection job for an S3 object."""
+
+    job_id = client.start_document_text_detection(
+        DocumentLocation={'S3Object': {'Bucket': bucket, 'Name': key}}
+    )['JobId']
+    logger.info("Started Textract job %s for s3://%s/%s", job_id, bucket, key)
+    return job_id
+
+def iter_textract_pages(client, job_id):
+    """Yield (page, text) for each page as the Textract results are paginated,
+    so only one page of lines is held in memory at a time."""
+
+    next_token = None
+    page = None
+    lines = []
+    while True:
+        request = {'JobId': job_id, 'MaxResults': 1000}
+        if next_token:
+            request['NextToken'] = next_token
+        response = client.get_document_text_detection(**request)
+
+        status = response['JobStatus']
+        if status == 'IN_PROGRESS':
+            time.sleep(TEXTRACT_POLL_SECONDS)
+            continue
+        if status == 'FAILED':
+            raise RuntimeError(f"Textract job {job_id} failed: {response.get('StatusMessage')}")
+        if status == 'PARTIAL_SUCCESS':
+            logger.warning("Textract job %s partially succeeded: %s", job_id, response.get('Warnings'))
+
+        for block in response['Blocks']:
+            if block['BlockType'] != 'LINE':
+                continue
+            if page is not None and block['Page'] != page:
+                yield page, "\n".join(lines)
+                lines = []
+            page = block['Page']
+            lines.append(block['Text'])
+
+        next_token = response.get('NextToken')
+        if not next_token:
+            break
+
+    if page is not None:
+        yield page, "\n".join(lines)
+
+def iter_chunks(pages, source, text_splitter):
+    for page, text in pages:
+        for doc in text_splitter.split_documents([Document(page_content=text, metadata={'source': source, 'page': page})]):
+            yield {"page_content": doc.page_content, "metadata": doc.metadata}
+
+def write_jsonl_shards(bucket_name, document_name, chunks):
+    """Write chunks as JSON Lines shards under documents/<name>/ and return that prefix."""
+
+    prefix = f"documents/{document_name}/"
+
+    # Drop shards left over from an earlier, longer version of the document; the
+    # delimiter keeps the shards of documents in a folder of the same name
+    # (documents/a/ for a.pdf and documents/a/x/ for a/x.pdf) out of the listing
+    paginator = s3.get_paginator('list_objects_v2')
+    for listing in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter="/"):
+        stale = [{'Key': obj['Key']} for obj in listing.get('Contents', [])]
+        if stale:
+            s3.delete_objects(Bucket=bucket_name, Delete={'Objects': stale})
+
+    shard = []
+    shard_count = 0
+    chunk_count = 0
+    for chunk in chunks:
+        shard.append(json.dumps(chunk))
+        chunk_count += 1
+        if len(shard) == JSONL_SHARD_SIZE:
+            s3.put_object(Bucket=bucket_name, Key=f"{prefix}part-{shard_count:05d}.jsonl", Body="\n".join(shard).encode('utf-8'))
+            shard_count += 1
+            shard = []
+
+    if shard:
+        s3.put_object(Bucket=bucket_name, Key=f"{prefix}part-{shard_count:05d}.jsonl", Body="\n".join(shard).encode('utf-8'))
+        shard_count += 1
+
+    logger.info("Wrote %d chunks in %d shards to s3://%s/%s", chunk_count, shard_count, bucket_name, prefix)
+    return prefix
+
+def process_record(record, client, document_table_name, temporary_bucket_name):
+    """Register one uploaded file and either start its Textract job or, for file
+    types without the asynchronous API, extract it directly."""
+
+    bucket = record['s3']['bucket']['name']
+    key = unquote_plus(record['s3']['object']['key'])
+    event_time = record['eventTime']
+
+    _, file_extension = os.path.splitext(key)
+    clean_file_extension = file_extension.lstrip(".")
+    tmpKey = key.replace("public/", "")
+    document_name = os.path.splitext(tmpKey)[0]
+    item = {
+        'id': tmpKey,
+        'documentName': document_name,
+        'document_status': "Processing",
+        'uploadDate': event_time,
+        'type': clean_file_extension,
+        'vector': "",
+    }
+    if 'sha256' in record['s3']['object']:
+        item['content_hash'] = record['s3']['object']['sha256']
+    # boto3 resources are not thread safe, so each record uses its own session
+    table = boto3.session.Session().resource('dynamodb').Table(document_table_name)
+    table.put_item(Item=item)
+
+    if STREAMING_EXTRACTION and clean_file_extension.lower() in STREAMING_EXTENSIONS:
+        return {
+            'textract_job': {
+                'job_id': start_textract_job(client, bucket, key),
+                'bucket': bucket,
+                'key': key,
+                'document_name': document_name,
+            }
+        }
+
+    file_path = f"s3://{bucket}/{key}"
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=512, chunk_overlap=100)
+    loader = AmazonTextractPDFLoader(file_path, client=client)
+    raw_documents= loader.load()
+
+    documents = text_splitter.split_documents(raw_documents)
+
+    logger.info("Processed documents: %s", documents)
+    logger.info("Raw documents length: %d", len(raw_documents))
+
+    documents_as_dicts = [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in documents]
+    serialized_data = json.dumps(documents_as_dicts).encode('utf-8')
+    upload_to_s3(temporary_bucket_name, serialized_data, document_name)
+    return {'output_key': f"documents/{document_name}.json"}
+
+def collect_textract_job(job, client, temporary_bucket_name):
+    """Page through a finished Textract job and write its chunks as JSON Lines shards."""
+
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=512, chunk_overlap=100)
+    pages = iter_textract_pages(client, job['job_id'])
+    chunks = iter_chunks(pages, f"s3://{job['bucket']}/{job['key']}", text_splitter)
+    return {'output_key': write_jsonl_shards(temporary_bucket_name, job['document_name'], chunks)}
+
+def run_concurrently(function, items, *args):
+    # Each item is isolated: the result is either the return value or the exception
+    with ThreadPoolExecutor(max_workers=max(1, min(EXTRACTION_CONCURRENCY, len(items)))) as executor:
+        futures = [executor.submit(function, item, *args) for item in items]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except (ClientError, Exception) as e:
+            results.append(e)
+    return results
+
+def record_error(errors, e, bucket, key, document_table_name):
+    error_type = 'ClientError' if isinstance(e, ClientError) else 'UnexpectedError'
+    mark_document_as_failed(key.replace("public/", ""), document_table_name)
+    errors.append({
+        'statusCode': 500,
+        'type': error_type,
+        'message': str(e),
+        'bucketName': bucket,
+        'key': key
+    })
+    logger.error(f"{error_type} for bucket: {bucket}, key: {key}. Error: {str(e)}")
+
 def lambda_handler(event, context):
-    """Process uploaded files in an S3 bucket using Amazon Textract."""
+    """Process uploaded files in an S3 bucket using Amazon Textract.
+
+    Invoked twice by the pipeline for PDF and TIFF files: first with the S3
+    event to start the Textract jobs, then, once they have finished, with the
+    returned textract_jobs to collect the results."""
     
     TEMPORARY_BUCKET_NAME = os.environ["TEMPORARY_BUCKET_NAME"]
     DOCUMENT_TABLE_NAME = os.environ["DOCUMENT_TABLE_NAME"]
@@ -68,76 +251,63 @@ def lambda_handler(event, context):
     textract_client = boto3.client("textract", region_name=AWS_REGION)
     processed_files = []
     errors = []
+    documents = []
 
-    for record in event['Records']:
-        bucket = record['s3']['bucket']['name']
-        key = unquote_plus(record['s3']['object']['key'])
-        event_time = record['eventTime']
-    
-        try:
+    if 'textract_jobs' in event:
+        jobs = event['textract_jobs']
+        processed_files = event.get('processedFiles', [])
+        errors = event.get('errors', [])
+        # Documents extracted directly on the first invocation
+        documents = event.get('documents', [])
+        results = run_concurrently(collect_textract_job, jobs, textract_client, TEMPORARY_BUCKET_NAME)
+        sources = [(job['bucket'], job['key']) for job in jobs]
+    else:
+        records = event['Records']
+        results = run_concurrently(process_record, records, textract_client, DOCUMENT_TABLE_NAME, TEMPORARY_BUCKET_NAME)
+        sources = [(record['s3']['bucket']['name'], unquote_plus(record['s3']['object']['key'])) for record in records]
 
-            _, file_extension = os.path.splitext(key)
-            clean_file_extension = file_extension.lstrip(".")
-            tmpKey = key.replace("public/", "")
-            document_name = os.path.splitext(tmpKey)[0]
-            item = {
-                'id': tmpKey,
-                'documentName': document_name,
-                'document_status': "Processing",
-                'uploadDate': event_time,
-                'type': clean_file_extension,
-                'vector': "",         
-            }
-            table = dynamodb.Table(DOCUMENT_TABLE_NAME)
-            table.put_item(Item=item)
-
-            file_path = f"s3://{bucket}/{key}"
-            loader = AmazonTextractPDFLoader(file_path, client=textract_client)
-            raw_documents= loader.load()
-            
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=512, chunk_overlap=100)
-            documents = text_splitter.split_documents(raw_documents)
-            
-            logger.info("Processed documents: %s", documents)
-            logger.info("Raw documents length: %d", len(raw_documents))
-
-            documents_as_dicts = [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in documents]
-            serialized_data = json.dumps(documents_as_dicts).encode('utf-8')
-            upload_to_s3(TEMPORARY_BUCKET_NAME, serialized_data, document_name)
+    jobs = []
+    for (bucket, key), result in zip(sources, results):
+        if isinstance(result, Exception):
+            record_error(errors, result, bucket, key, DOCUMENT_TABLE_NAME)
+        elif 'textract_job' in result:
+            jobs.append(result['textract_job'])
+        else:
             processed_files.append(key)
-         
-        except (ClientError, Exception) as e:
-            error_type = 'ClientError' if isinstance(e, ClientError) else 'UnexpectedError'
-            mark_document_as_failed(key.replace("public/", ""), DOCUMENT_TABLE_NAME)
-            errors.append({
-                'statusCode': 500,
-                'type': error_type,
-                'message': str(e),
-                'bucketName': bucket,
-                'key': key
+            # One embedding input per document; the pipeline embeds them in a Map state
+            documents.append({
+                'document_key': key,
+                'output': {
+                    'bucket': TEMPORARY_BUCKET_NAME,
+                    'key': result['output_key'],
+                    'document_id': key.replace("public/", ""),
+                    'document_status': "Processing",
+                },
+                'dynamodb_table_name': DOCUMENT_TABLE_NAME,
+                'temporary_bucket_name': TEMPORARY_BUCKET_NAME,
+                'sagemaker_endpoint_name': EMBEDDINGS_ENDPOINT_NAME,
+                'document_output_bucket_name': OUTPUT_BUCKET_NAME
             })
-            logger.error(f"{error_type} for bucket: {bucket}, key: {key}. Error: {str(e)}")
 
-    if errors:
+    if jobs:
+        # Step Functions waits for the jobs and invokes this function again
         return {
-            'statusCode': 500,
+            'statusCode': 200,
+            'textract_jobs': jobs,
+            'textract_done': False,
+            'processedFiles': processed_files,
             'errors': errors,
-            'processedFiles': processed_files
+            'documents': documents
         }
 
+    # Failed documents are already marked as such; only fail the execution when none is left
+    if errors and not documents:
+        raise RuntimeError(f"Extraction failed for every document: {json.dumps(errors)}")
+
     return {
         'statusCode': 200,
-        'message': f"Processed files from bucket: {bucket}",
+        'message': f"Processed {len(documents)} files",
         'processedFiles': processed_files,
-        'document_key': key,
-        'output': {
-            'bucket': TEMPORARY_BUCKET_NAME,
-            'key': f"documents/{document_name}.json",
-            'document_id': key.replace("public/", ""),
-            'document_status': "Processing",
-        },
-        'dynamodb_table_name': DOCUMENT_TABLE_NAME,
-        'temporary_bucket_name': TEMPORARY_BUCKET_NAME,
-        'sagemaker_endpoint_name': EMBEDDINGS_ENDPOINT_NAME,
-        'document_output_bucket_name': OUTPUT_BUCKET_NAME
+        'errors': errors,
+        'documents': documents
     }
@@ -13,39 +13,20 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-# --
-# --  Author:        Jin Tan Ruan
-# --  Date:          04/11/2023
-# --  Purpose:       Checks ECS Task Status
-# --  Version:       0.1.0
-# --  Disclaimer:    This code is provided "as is" in accordance with the repository license
-# --  History
-# --  When        Version     Who         What
-# --  -----------------------------------------------------------------
-# --  04/11/2023  0.1.0       jtanruan    Initial
-# --  -----------------------------------------------------------------
-# --
+# Checks Textract Job Status
 
 import boto3
-import os
 
-client = boto3.client('ecs')
+client = boto3.client('textract')
 
 def lambda_handler(event, context):
-    task_arn = event['task_arn']
-    response = client.describe_tasks(
-        cluster=os.environ['ECS_CLUSTER_NAME'],
-        tasks=[task_arn]
-    )
-    status = response['tasks'][0]['lastStatus']
-    if status == 'STOPPED':
-        return {
-            'done': True,
-            'task_arn': task_arn,
+    done = True
+    for job in event['textract_jobs']:
+        # Only the status is needed, so fetch the smallest page of results
+        response = client.get_document_text_detection(JobId=job['job_id'], MaxResults=1)
+        job['job_status'] = response['JobStatus']
+        if job['job_status'] == 'IN_PROGRESS':
+            done = False
 
-        }
-    else:
-        return {
-            'done': False,
-            'task_arn': task_arn,
-        }
\ No newline at end of file
+    event['textract_done'] = done
+    return event
@@ -27,6 +27,7 @@
 # --
 
 import boto3
+import hashlib
 import json
 import os
 import urllib.parse
@@ -36,15 +37,41 @@ from botocore.exceptions import ClientError
 
 s3 = boto3.client('s3')
 stepfunctions = boto3.client('stepfunctions')
+dynamodb = boto3.resource('dynamodb')
+
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+# Objects under this prefix are loaded by the bulk ingest state machine
+BULK_INGEST_PREFIX = os.environ.get("BULK_INGEST_PREFIX", "public/bulk/")
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+def get_content_hash(bucket, key):
+    """SHA-256 of the object, streamed so large PDFs are never held in memory."""
+    digest = hashlib.sha256()
+    body = s3.get_object(Bucket=bucket, Key=key)['Body']
+    for chunk in body.iter_chunks(chunk_size=HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def is_unchanged(document_id, content_hash):
+    """True when the document was already embedded from identical content."""
+    table = dynamodb.Table(os.environ['DOCUMENT_TABLE_NAME'])
+    item = table.get_item(Key={'id': document_id}).get('Item')
+    return bool(item) and item.get('content_hash') == content_hash and item.get('document_status') == "Completed"
+
 def lambda_handler(event, context):
     # Get the bucket name and file key from the event
     bucket = event['Records'][0]['s3']['bucket']['name']
     key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
 
+    if key.startswith(BULK_INGEST_PREFIX):
+        return {
+            'statusCode': 200,
+            'message': f"Document with ID {key} is left to the bulk ingest pipeline.",
+            'key': key
+        }
+
     try:
         # Rename the file if it has spaces
         new_key = key.replace(" ", "")
@@ -55,6 +82,18 @@ def lambda_handler(event, context):
             # Update the event with the new key
             event['Records'][0]['s3']['object']['key'] = new_key
 
+        # Skip Textract and embedding when the same content is uploaded again
+        content_hash = get_content_hash(bucket, new_key)
+        document_id = new_key.replace("public/", "")
+        if is_unchanged(document_id, content_hash):
+            logger.info(f"Document {document_id} is unchanged (sha256 {content_hash}), skipping the pipeline")
+            return {
+                'statusCode': 200,
+                'message': f"Document with ID {key} is unchanged, pipeline not started.",
+                'key': key
+            }
+        event['Records'][0]['s3']['object']['sha256'] = content_hash
+
         # Trigger the Step Function with the updated event
         STATE_MACHINE_ARN = os.environ['STATE_MACHINE_ARN']
         stepfunctions.start_execution(
@@ -27,6 +27,7 @@
 # --
 
 import boto3
+import json
 import os
 
 def lambda_handler(event, context):
@@ -38,6 +39,10 @@ def lambda_handler(event, context):
     TASK_DEFINITION = os.environ['TASK_DEFINITION']
     OUTPUT_BUCKET_NAME = os.environ['OUTPUT_BUCKET_NAME']
 
+    # The pipeline waits until the embedding task returns this token with the result
+    task_token = event['task_token']
+    event = event['input']
+
     bucket = event['output']['bucket']
     key = event['output']['key']
     document_key = event['document_key']
@@ -47,6 +52,36 @@ def lambda_handler(event, context):
     temporary_bucket_name = event['temporary_bucket_name']
     sagemaker_endpoint_name = event['sagemaker_endpoint_name']
 
+    result = {
+        'statusCode': 200,
+        'output': {
+            'bucket': bucket,
+            'key': key,
+            'document_key': document_key,
+            'document_id': document_id,
+            'document_status': document_status,
+        },
+        'temporary_bucket_name': temporary_bucket_name,
+        'dynamodb_table_name': dynamodb_table_name,
+        'sagemaker_endpoint_name': sagemaker_endpoint_name,
+        'document_output_bucket_name': OUTPUT_BUCKET_NAME
+    }
+
+    # With embedding workers running, the document is queued instead of starting a task
+    EMBEDDING_QUEUE_URL = os.environ.get('EMBEDDING_QUEUE_URL')
+    if EMBEDDING_QUEUE_URL:
+        boto3.client('sqs').send_message(
+            QueueUrl=EMBEDDING_QUEUE_URL,
+            MessageBody=json.dumps({
+                'bucket': bucket,
+                'key': key,
+                'document_id': document_id,
+                'dynamodb_table_name': dynamodb_table_name,
+                'task_token': task_token,
+            })
+        )
+        return {**result, 'body': "Embedding job queued."}
+
     launch_type = 'FARGATE'
     
     # Assuming your VPC has at least 2 public subnets.
@@ -80,29 +115,22 @@ def lambda_handler(event, context):
                     {'name': 'DOCUMENT_STATUS', 'value': document_status},
                     {'name': 'DYNAMODB_TABLE_NAME', 'value': dynamodb_table_name},
                     {'name': 'TEMP_BUCKET_NAME', 'value': temporary_bucket_name},
-                    {'name': 'EMBEDDINGS_ENDPOINT_NAME', 'value': sagemaker_endpoint_name}
+                    {'name': 'EMBEDDINGS_ENDPOINT_NAME', 'value': sagemaker_endpoint_name},
+                    {'name': 'TASK_TOKEN', 'value': task_token}
                     ]
                 }]
             }
         )
-        
+
+    # Capacity and placement errors are returned here rather than raised
+    if not response['tasks']:
+        raise RuntimeError(f"Could not start the embedding task: {response['failures']}")
+
     task_arn = response['tasks'][0]['taskArn']
         
     return {
-        'statusCode': 200,
+        **result,
         'body': "ECS tasks started.",
         'taskArn': task_arn,
-        'output': {
-            'bucket': bucket,
-            'key': key,
-            'document_key': document_key,
-            'document_id': document_id,
-            'document_status': document_status,
-        },
-        'temporary_bucket_name': temporary_bucket_name,
-        'dynamodb_table_name': dynamodb_table_name,
-        'sagemaker_endpoint_name': sagemaker_endpoint_name,
         'task_arn': task_arn,
-        'document_output_bucket_name': OUTPUT_BUCKET_NAME
-
     }
\ No newline at end of file
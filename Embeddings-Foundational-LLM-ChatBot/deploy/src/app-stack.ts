@@ -28,6 +28,9 @@
 
 import * as ec2 from "aws-cdk-lib/aws-ec2";
 import * as ecs from "aws-cdk-lib/aws-ecs";
+import * as events from "aws-cdk-lib/aws-events";
+import * as eventsTargets from "aws-cdk-lib/aws-events-targets";
+import * as sqs from "aws-cdk-lib/aws-sqs";
 import * as stepfunctionsTasks from "aws-cdk-lib/aws-stepfunctions-tasks";
 import { aws_logs as logs } from "aws-cdk-lib";
 import * as stepfunctions from "aws-cdk-lib/aws-stepfunctions";
@@ -295,6 +298,28 @@ export class AppStack extends cdk.Stack {
       })
     );
 
+    taskRole.addToPolicy(
+      new iam.PolicyStatement({
+        effect: iam.Effect.ALLOW,
+        actions: ["dynamodb:BatchGetItem", "dynamodb:BatchWriteItem"],
+        resources: [
+          `arn:aws:dynamodb:${awsRegion}:${awsAccountId}:table/${chatContextTable.tableName}`,
+        ],
+      })
+    );
+
+    taskRole.addToPolicy(
+      new iam.PolicyStatement({
+        effect: iam.Effect.ALLOW,
+        actions: ["s3:ListBucket"],
+        // Without it a missing corpus manifest is AccessDenied, not NoSuchKey
+        resources: [
+          `arn:aws:s3:::${temporaryDocumentBucket.bucketName}`,
+          `arn:aws:s3:::${documentOutputBucket.bucketName}`,
+        ],
+      })
+    );
+
     taskRole.addToPolicy(
       new iam.PolicyStatement({
         effect: iam.Effect.ALLOW,
@@ -330,8 +355,89 @@ export class AppStack extends cdk.Stack {
         cpu: 1024,
         memoryLimitMiB: 4096,
         logging: logging,
+        environment: {
+          CORPUS_INDEX_ENABLED: "False",
+          CORPUS_SHARDS: "1",
+          INDEX_TYPE: "flat",
+          EMBEDDING_CACHE_TABLE_NAME: chatContextTable.tableName,
+        },
+      }
+    );
+
+    // Long running embedding workers pulling document jobs from a queue. With 0
+    // workers the pipeline starts one Fargate task per document instead.
+    const embeddingWorkerCount = 0;
+
+    const embeddingDeadLetterQueue = new sqs.Queue(
+      this,
+      props.resourcePrefix + "embeddingDeadLetterQueue",
+      {
+        enforceSSL: true,
+      }
+    );
+
+    const embeddingQueueVisibilityTimeout = cdk.Duration.minutes(30);
+    const embeddingQueueMaxReceiveCount = 3;
+    const embeddingQueue = new sqs.Queue(
+      this,
+      props.resourcePrefix + "embeddingQueue",
+      {
+        visibilityTimeout: embeddingQueueVisibilityTimeout,
+        enforceSSL: true,
+        deadLetterQueue: {
+          queue: embeddingDeadLetterQueue,
+          maxReceiveCount: embeddingQueueMaxReceiveCount,
+        },
       }
     );
+    embeddingQueue.grantConsumeMessages(taskRole);
+
+    const workerTaskDefinition = new ecs.FargateTaskDefinition(
+      this,
+      props.resourcePrefix + "workerTaskDefinition",
+      {
+        runtimePlatform: {
+          cpuArchitecture: ecs.CpuArchitecture.ARM64,
+        },
+        cpu: 2048,
+        memoryLimitMiB: 6144,
+        executionRole: taskExecutionRole,
+        taskRole: taskRole,
+      }
+    );
+
+    workerTaskDefinition.addContainer(props.resourcePrefix + "workerContainer", {
+      image: ecs.ContainerImage.fromAsset("../ecs_task_definition"),
+      cpu: 2048,
+      memoryLimitMiB: 6144,
+      logging: logging,
+      environment: {
+        TASK_ACTION: "worker",
+        EMBEDDING_QUEUE_URL: embeddingQueue.queueUrl,
+        WORKER_MAX_RECEIVES: embeddingQueueMaxReceiveCount.toString(),
+        WORKER_VISIBILITY_TIMEOUT_SECONDS: embeddingQueueVisibilityTimeout
+          .toSeconds()
+          .toString(),
+        DYNAMODB_TABLE_NAME: documentTable.tableName,
+        TEMP_BUCKET_NAME: temporaryDocumentBucket.bucketName,
+        EMBEDDINGS_ENDPOINT_NAME: endpoint_name,
+        OUTPUT_BUCKET_NAME: documentOutputBucket.bucketName,
+        CORPUS_INDEX_ENABLED: "False",
+        CORPUS_SHARDS: "1",
+        INDEX_TYPE: "flat",
+        EMBEDDING_CACHE_TABLE_NAME: chatContextTable.tableName,
+      },
+    });
+
+    if (embeddingWorkerCount > 0) {
+      new ecs.FargateService(this, props.resourcePrefix + "embeddingWorkers", {
+        cluster,
+        taskDefinition: workerTaskDefinition,
+        desiredCount: embeddingWorkerCount,
+        assignPublicIp: true,
+        vpcSubnets: { subnetType: ec2.SubnetType.PUBLIC },
+      });
+    }
 
     const listDocumentHandlerFn = new lambdaPython.PythonFunction(
       this,
@@ -402,10 +508,15 @@ export class AppStack extends cdk.Stack {
           INPUT_BUCKET_NAME: documentInputBucket.bucketName,
           OUTPUT_BUCKET_NAME: documentOutputBucket.bucketName,
           CONTAINER_NAME: container.containerName,
+          ...(embeddingWorkerCount > 0
+            ? { EMBEDDING_QUEUE_URL: embeddingQueue.queueUrl }
+            : {}),
         },
       }
     );
 
+    embeddingQueue.grantSendMessages(embeddingHandlerFn);
+
     embeddingHandlerFn.addToRolePolicy(
       new iam.PolicyStatement({
         effect: iam.Effect.ALLOW,
@@ -467,6 +578,17 @@ export class AppStack extends cdk.Stack {
       })
     );
 
+    textractDocumentHandlerFn.addToRolePolicy(
+      new iam.PolicyStatement({
+        effect: iam.Effect.ALLOW,
+        actions: ["s3:ListBucket", "s3:DeleteObject"],
+        resources: [
+          `arn:aws:s3:::${temporaryDocumentBucket.bucketName}`,
+          `arn:aws:s3:::${temporaryDocumentBucket.bucketName}/*`,
+        ],
+      })
+    );
+
     textractDocumentHandlerFn.addToRolePolicy(
       new iam.PolicyStatement({
         effect: iam.Effect.ALLOW,
@@ -546,36 +668,39 @@ export class AppStack extends cdk.Stack {
       })
     );
 
-    const checkCompletionHandlerFn = new lambdaPython.PythonFunction(
+    const textractStatusHandlerFn = new lambdaPython.PythonFunction(
       this,
-      props.resourcePrefix + "checkEcsCompletionHandlerFn",
+      props.resourcePrefix + "textractStatusHandlerFn",
       {
         runtime: Runtime.PYTHON_3_9,
         handler: "lambda_handler",
         index: "lambda_function.py",
-        entry: "../api/check-status",
-        timeout: cdk.Duration.minutes(15),
+        entry: "../api/textract-status",
+        timeout: cdk.Duration.minutes(1),
         retryAttempts: 0,
-        memorySize: 1024,
+        memorySize: 256,
         architecture: cdk.aws_lambda.Architecture.X86_64,
-        environment: {
-          ECS_CLUSTER_NAME: cluster.clusterName,
-          CLUSTER_NAME: cluster.clusterName,
-          TASK_DEFINITION: taskDefinition.taskDefinitionArn,
-          SUBNET_1: vpc.publicSubnets[0].subnetId,
-          SUBNET_2: vpc.publicSubnets[1].subnetId,
-          INPUT_BUCKET_NAME: documentInputBucket.bucketName,
-          OUTPUT_BUCKET_NAME: documentOutputBucket.bucketDomainName,
-        },
       }
     );
 
-    checkCompletionHandlerFn.addToRolePolicy(
+    textractStatusHandlerFn.addToRolePolicy(
+      new iam.PolicyStatement({
+        effect: iam.Effect.ALLOW,
+        actions: ["textract:GetDocumentTextDetection"],
+        resources: ["*"],
+      })
+    );
+
+    textractStatusHandlerFn.addToRolePolicy(
       new iam.PolicyStatement({
         effect: iam.Effect.ALLOW,
-        actions: ["ecs:DescribeTasks"],
+        actions: [
+          "logs:CreateLogGroup",
+          "logs:CreateLogStream",
+          "logs:PutLogEvents",
+        ],
         resources: [
-          `arn:aws:ecs:${awsRegion}:${awsAccountId}:task/${cluster.clusterName}/*`,
+          `arn:aws:logs:${awsRegion}:${awsAccountId}:log-group:/aws/lambda/*`,
         ],
       })
     );
@@ -589,28 +714,50 @@ export class AppStack extends cdk.Stack {
       }
     );
 
-    const embeddingTask = new stepfunctionsTasks.LambdaInvoke(
+    const waitForTextract = new stepfunctions.Wait(this, "Wait For Textract", {
+      time: stepfunctions.WaitTime.duration(cdk.Duration.seconds(30)),
+    });
+
+    const checkTextractCompletionTask = new stepfunctionsTasks.LambdaInvoke(
       this,
-      "Text Embedding",
+      "Is Textract Job Complete?",
       {
-        lambdaFunction: embeddingHandlerFn,
+        lambdaFunction: textractStatusHandlerFn,
         outputPath: "$.Payload",
       }
     );
 
-    const wait30Seconds = new stepfunctions.Wait(this, "Wait 30 Seconds", {
-      time: stepfunctions.WaitTime.duration(cdk.Duration.seconds(30)),
-    });
-
-    const checkEcsCompletionTask = new stepfunctionsTasks.LambdaInvoke(
+    const collectTextractTask = new stepfunctionsTasks.LambdaInvoke(
       this,
-      "Is Ecs Task Complete?",
+      "Collect Textract Results",
       {
-        lambdaFunction: checkCompletionHandlerFn,
+        lambdaFunction: textractDocumentHandlerFn,
         outputPath: "$.Payload",
       }
     );
 
+    // The embedding task reports back with SendTaskSuccess or SendTaskFailure,
+    // so the pipeline advances as soon as the vectorstore is written
+    const embeddingTask = new stepfunctionsTasks.LambdaInvoke(
+      this,
+      "Text Embedding",
+      {
+        lambdaFunction: embeddingHandlerFn,
+        integrationPattern: stepfunctions.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
+        payload: stepfunctions.TaskInput.fromObject({
+          task_token: stepfunctions.JsonPath.taskToken,
+          input: stepfunctions.JsonPath.entirePayload,
+        }),
+        timeout: cdk.Duration.minutes(60),
+      }
+    );
+
+    // The extraction returns one embedding input per document of the event
+    const embedDocumentsMap = new stepfunctions.Map(this, "Embed Documents", {
+      itemsPath: "$.documents",
+    });
+    embedDocumentsMap.iterator(embeddingTask);
+
     const errorState = new stepfunctionsTasks.LambdaInvoke(
       this,
       "Catching an Error",
@@ -629,24 +776,47 @@ export class AppStack extends cdk.Stack {
       },
     });
 
-    const isDoneChoice = new stepfunctions.Choice(this, "Is Ecs Task Done?");
-    isDoneChoice.when(
-      stepfunctions.Condition.booleanEquals("$.done", true),
-      endState
+    // PDF and TIFF files are extracted by asynchronous Textract jobs, polled
+    // here instead of blocking the extraction Lambda
+    const hasTextractJobsChoice = new stepfunctions.Choice(
+      this,
+      "Has Textract Jobs?"
+    );
+    hasTextractJobsChoice.when(
+      stepfunctions.Condition.isPresent("$.textract_jobs"),
+      waitForTextract
+    );
+    hasTextractJobsChoice.otherwise(embedDocumentsMap);
+
+    const isTextractDoneChoice = new stepfunctions.Choice(
+      this,
+      "Is Textract Job Done?"
     );
-    isDoneChoice.otherwise(wait30Seconds);
+    isTextractDoneChoice.when(
+      stepfunctions.Condition.booleanEquals("$.textract_done", true),
+      collectTextractTask
+    );
+    isTextractDoneChoice.otherwise(waitForTextract);
 
-    wait30Seconds.next(checkEcsCompletionTask);
-    checkEcsCompletionTask.next(isDoneChoice);
+    waitForTextract.next(checkTextractCompletionTask);
+    checkTextractCompletionTask.next(isTextractDoneChoice);
+    collectTextractTask.next(embedDocumentsMap);
 
     textractTask.addCatch(errorState, {
       resultPath: "$.errorInfo",
     });
-    embeddingTask.addCatch(errorState, {
+    embedDocumentsMap.addCatch(errorState, {
+      resultPath: "$.errorInfo",
+    });
+    checkTextractCompletionTask.addCatch(errorState, {
+      resultPath: "$.errorInfo",
+    });
+    collectTextractTask.addCatch(errorState, {
       resultPath: "$.errorInfo",
     });
 
-    const definition = textractTask.next(embeddingTask).next(wait30Seconds);
+    embedDocumentsMap.next(endState);
+    const definition = textractTask.next(hasTextractJobsChoice);
 
     const logPipelineGroup = new logs.LogGroup(
       this,
@@ -658,7 +828,7 @@ export class AppStack extends cdk.Stack {
       props.resourcePrefix + "documentEmbeddingsPipeline",
       {
         definition,
-        timeout: cdk.Duration.minutes(60),
+        timeout: cdk.Duration.minutes(120),
         tracingEnabled: true,
         logs: {
           destination: logPipelineGroup,
@@ -667,6 +837,224 @@ export class AppStack extends cdk.Stack {
       }
     );
 
+    documentEmbeddingsPipeline.grantTaskResponse(taskRole);
+
+    // An embedding task that stops without reporting back (out of memory, image
+    // pull or capacity errors) fails its execution instead of leaving it waiting
+    const taskStoppedHandlerFn = new lambdaPython.PythonFunction(
+      this,
+      props.resourcePrefix + "taskStoppedHandlerFn",
+      {
+        runtime: Runtime.PYTHON_3_9,
+        handler: "lambda_handler",
+        index: "lambda_function.py",
+        entry: "../api/task-stopped",
+        timeout: cdk.Duration.minutes(1),
+        retryAttempts: 2,
+        memorySize: 256,
+        architecture: cdk.aws_lambda.Architecture.X86_64,
+        environment: {
+          CONTAINER_NAME: container.containerName,
+        },
+      }
+    );
+
+    documentEmbeddingsPipeline.grantTaskResponse(taskStoppedHandlerFn);
+
+    taskStoppedHandlerFn.addToRolePolicy(
+      new iam.PolicyStatement({
+        effect: iam.Effect.ALLOW,
+        actions: ["dynamodb:UpdateItem"],
+        resources: [
+          `arn:aws:dynamodb:${awsRegion}:${awsAccountId}:table/${documentTable.tableName}`,
+        ],
+      })
+    );
+
+    taskStoppedHandlerFn.addToRolePolicy(
+      new iam.PolicyStatement({
+        effect: iam.Effect.ALLOW,
+        actions: [
+          "logs:CreateLogGroup",
+          "logs:CreateLogStream",
+          "logs:PutLogEvents",
+        ],
+        resources: [
+          `arn:aws:logs:${awsRegion}:${awsAccountId}:log-group:/aws/lambda/*`,
+        ],
+      })
+    );
+
+    new events.Rule(this, props.resourcePrefix + "embeddingTaskStoppedRule", {
+      eventPattern: {
+        source: ["aws.ecs"],
+        detailType: ["ECS Task State Change"],
+        detail: {
+          clusterArn: [cluster.clusterArn],
+          taskDefinitionArn: [taskDefinition.taskDefinitionArn],
+          lastStatus: ["STOPPED"],
+        },
+      },
+      targets: [new eventsTargets.LambdaFunction(taskStoppedHandlerFn)],
+    });
+
+    // Bulk ingestion: pages of documents under a prefix or listed in a manifest
+    // are fanned out to the pipeline with bounded concurrency
+    const bulkIngestConcurrency = 10;
+    const bulkIngestPipelineName = props.resourcePrefix + "bulkIngestPipeline";
+
+    const bulkIngestHandlerFn = new lambdaPython.PythonFunction(
+      this,
+      props.resourcePrefix + "bulkIngestHandlerFn",
+      {
+        runtime: Runtime.PYTHON_3_9,
+        handler: "lambda_handler",
+        index: "lambda_function.py",
+        entry: "../api/bulk-ingest",
+        timeout: cdk.Duration.minutes(5),
+        retryAttempts: 0,
+        memorySize: 1024,
+        architecture: cdk.aws_lambda.Architecture.X86_64,
+        environment: {
+          DOCUMENT_TABLE_NAME: documentTable.tableName,
+          INPUT_BUCKET_NAME: documentInputBucket.bucketName,
+        },
+      }
+    );
+
+    bulkIngestHandlerFn.addToRolePolicy(
+      new iam.PolicyStatement({
+        effect: iam.Effect.ALLOW,
+        actions: ["s3:ListBucket", "s3:GetObject"],
+        resources: [
+          `arn:aws:s3:::${documentInputBucket.bucketName}`,
+          `arn:aws:s3:::${documentInputBucket.bucketName}/*`,
+        ],
+      })
+    );
+
+    bulkIngestHandlerFn.addToRolePolicy(
+      new iam.PolicyStatement({
+        effect: iam.Effect.ALLOW,
+        actions: ["dynamodb:BatchGetItem", "dynamodb:BatchWriteItem"],
+        resources: [
+          `arn:aws:dynamodb:${awsRegion}:${awsAccountId}:table/${documentTable.tableName}`,
+        ],
+      })
+    );
+
+    bulkIngestHandlerFn.addToRolePolicy(
+      new iam.PolicyStatement({
+        effect: iam.Effect.ALLOW,
+        actions: [
+          "logs:CreateLogGroup",
+          "logs:CreateLogStream",
+          "logs:PutLogEvents",
+        ],
+        resources: [
+          `arn:aws:logs:${awsRegion}:${awsAccountId}:log-group:/aws/lambda/*`,
+        ],
+      })
+    );
+
+    const listDocumentsPageTask = new stepfunctionsTasks.LambdaInvoke(
+      this,
+      "List Documents Page",
+      {
+        lambdaFunction: bulkIngestHandlerFn,
+        outputPath: "$.Payload",
+      }
+    );
+
+    const ingestDocumentTask =
+      new stepfunctionsTasks.StepFunctionsStartExecution(
+        this,
+        "Ingest Document",
+        {
+          stateMachine: documentEmbeddingsPipeline,
+          integrationPattern: stepfunctions.IntegrationPattern.RUN_JOB,
+          input: stepfunctions.TaskInput.fromJsonPathAt("$"),
+          resultPath: stepfunctions.JsonPath.DISCARD,
+        }
+      );
+
+    // A failed document is already marked as Failed; the load carries on
+    ingestDocumentTask.addCatch(
+      new stepfunctions.Pass(this, "Document Ingest Failed"),
+      {
+        resultPath: "$.errorInfo",
+      }
+    );
+
+    const ingestPageMap = new stepfunctions.Map(this, "Ingest Documents Page", {
+      itemsPath: "$.records",
+      maxConcurrency: bulkIngestConcurrency,
+      resultPath: stepfunctions.JsonPath.DISCARD,
+    });
+    ingestPageMap.iterator(ingestDocumentTask);
+
+    // Keeps each execution below the history event quota on large loads
+    const continueBulkIngestTask = new stepfunctionsTasks.CallAwsService(
+      this,
+      "Continue In New Execution",
+      {
+        service: "sfn",
+        action: "startExecution",
+        parameters: {
+          StateMachineArn: stepfunctions.JsonPath.stringAt("$$.StateMachine.Id"),
+          Input: stepfunctions.JsonPath.jsonToString(
+            stepfunctions.JsonPath.objectAt("$.next_execution")
+          ),
+        },
+        iamAction: "states:StartExecution",
+        iamResources: [
+          `arn:aws:states:${awsRegion}:${awsAccountId}:stateMachine:${bulkIngestPipelineName}`,
+        ],
+      }
+    );
+
+    const bulkIngestComplete = new stepfunctions.Succeed(
+      this,
+      "Bulk Ingest Complete"
+    );
+
+    const hasMoreDocumentsChoice = new stepfunctions.Choice(
+      this,
+      "More Documents?"
+    );
+    hasMoreDocumentsChoice.when(
+      stepfunctions.Condition.booleanEquals("$.has_more", true),
+      listDocumentsPageTask
+    );
+    hasMoreDocumentsChoice.when(
+      stepfunctions.Condition.isPresent("$.next_execution"),
+      continueBulkIngestTask
+    );
+    hasMoreDocumentsChoice.otherwise(bulkIngestComplete);
+
+    continueBulkIngestTask.next(bulkIngestComplete);
+
+    const bulkIngestLogGroup = new logs.LogGroup(
+      this,
+      props.resourcePrefix + "bulkIngestLogGroup"
+    );
+
+    new stepfunctions.StateMachine(
+      this,
+      props.resourcePrefix + "bulkIngestPipeline",
+      {
+        stateMachineName: bulkIngestPipelineName,
+        definition: listDocumentsPageTask
+          .next(ingestPageMap)
+          .next(hasMoreDocumentsChoice),
+        tracingEnabled: true,
+        logs: {
+          destination: bulkIngestLogGroup,
+          level: stepfunctions.LogLevel.ALL,
+        },
+      }
+    );
+
     const s3TriggerPipelineHandlerFn = new lambdaPython.PythonFunction(
       this,
       props.resourcePrefix + "s3TriggerPipelineHandlerFn",
@@ -681,10 +1069,21 @@ export class AppStack extends cdk.Stack {
         architecture: cdk.aws_lambda.Architecture.X86_64,
         environment: {
           STATE_MACHINE_ARN: documentEmbeddingsPipeline.stateMachineArn,
+          DOCUMENT_TABLE_NAME: documentTable.tableName,
         },
       }
     );
 
+    s3TriggerPipelineHandlerFn.addToRolePolicy(
+      new iam.PolicyStatement({
+        effect: iam.Effect.ALLOW,
+        actions: ["dynamodb:GetItem"],
+        resources: [
+          `arn:aws:dynamodb:${awsRegion}:${awsAccountId}:table/${documentTable.tableName}`,
+        ],
+      })
+    );
+
     s3TriggerPipelineHandlerFn.addEventSource(
       new S3EventSource(documentInputBucket, {
         events: [
@@ -1026,23 +1425,35 @@ export class AppStack extends cdk.Stack {
       })
     );
 
-    const chatHandlerFn = new lambdaPython.PythonFunction(
+    // The chat handler runs as a small HTTP server behind the Lambda Web
+    // Adapter, so its function URL can stream answers token by token
+    const lambdaWebAdapterLayer = LayerVersion.fromLayerVersionArn(
+      this,
+      props.resourcePrefix + "lambdaWebAdapterLayer",
+      `arn:aws:lambda:${awsRegion}:753240598075:layer:LambdaAdapterLayerArm64:17`
+    );
+
+    const chatHandlerFn = new cdk.aws_lambda.Function(
       this,
       props.resourcePrefix + "chatHandlerFn",
       {
         runtime: cdk.aws_lambda.Runtime.PYTHON_3_10,
-        handler: "lambda_handler",
-        index: "lambda_function.py",
-        entry: "../api/chat-handler",
+        handler: "run.sh",
+        code: Code.fromAsset("../api/chat-handler"),
         timeout: cdk.Duration.minutes(15),
         memorySize: 4096,
         architecture: Architecture.ARM_64,
-        layers: [bedrockLangchainLayer],
+        layers: [bedrockLangchainLayer, lambdaWebAdapterLayer],
         environment: {
           CONTEXT_TABLE_NAME: chatContextTable.tableName,
           S3_ASSETS_BUCKET_NAME: documentOutputBucket.bucketName,
           EMBEDDINGS_SAGEMAKER_ENDPOINT: endpoint_name,
+          EMBEDDING_CACHE_TABLE_NAME: chatContextTable.tableName,
           AWS_INTERNAL: authentication,
+          BEDROCK_STREAMING: "True",
+          AWS_LAMBDA_EXEC_WRAPPER: "/opt/bootstrap",
+          AWS_LWA_INVOKE_MODE: "response_stream",
+          PORT: "8080",
         },
       }
     );
@@ -1057,6 +1468,7 @@ export class AppStack extends cdk.Stack {
 
     const chatHandlerUrl = chatHandlerFn.addFunctionUrl({
       authType: cdk.aws_lambda.FunctionUrlAuthType.AWS_IAM,
+      invokeMode: cdk.aws_lambda.InvokeMode.RESPONSE_STREAM,
       cors: {
         allowedOrigins: ["*"],
         allowedMethods: [
@@ -1105,7 +1517,7 @@ export class AppStack extends cdk.Stack {
     chatHandlerFn.addToRolePolicy(
       new iam.PolicyStatement({
         effect: iam.Effect.ALLOW,
-        actions: ["bedrock:InvokeModel"],
+        actions: ["bedrock:InvokeModel", "bedrock:InvokeModelWithResponseStream"],
         resources: ["*"],
       })
     );
@@ -1124,6 +1536,14 @@ export class AppStack extends cdk.Stack {
       })
     );
 
+    chatHandlerFn.addToRolePolicy(
+      new iam.PolicyStatement({
+        effect: iam.Effect.ALLOW,
+        actions: ["s3:ListBucket"],
+        resources: [`arn:aws:s3:::${documentOutputBucket.bucketName}`],
+      })
+    );
+
     chatHandlerFn.addToRolePolicy(
       new iam.PolicyStatement({
         effect: iam.Effect.ALLOW,
@@ -1132,6 +1552,7 @@ export class AppStack extends cdk.Stack {
           "dynamodb:UpdateItem",
           "dynamodb:Scan",
           "dynamodb:GetItem",
+          "dynamodb:Query",
         ],
         resources: [
           `arn:aws:dynamodb:${awsRegion}:${awsAccountId}:table/${chatContextTable.tableName}`,
@@ -26,20 +26,35 @@
 # --  -----------------------------------------------------------------
 # --
 
+import hashlib
 import json
 import os
 import logging
+import random
+import shutil
+import sqlite3
+import threading
+import time
+import zlib
 import traceback
+import uuid
 from botocore.exceptions import ClientError
 import boto3
 import zipfile
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
 from langchain.embeddings.sagemaker_endpoint import EmbeddingsContentHandler
 from langchain.llms.sagemaker_endpoint import ContentHandlerBase
 from langchain.vectorstores.faiss import FAISS
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.embeddings import SagemakerEndpointEmbeddings
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List
 import botocore
+import faiss
+import numpy as np
 
 # Initial Setup
 s3 = boto3.client('s3')
@@ -48,24 +63,70 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # Environment Variables
-S3_BUCKET_NAME = os.environ['S3_BUCKET_NAME']
-S3_FILE_KEY = os.environ['S3_FILE_KEY']
-DOCUMENT_ID = os.environ['DOCUMENT_ID']
+# The document variables are only set for one-off tasks; workers read them from each job
+S3_BUCKET_NAME = os.environ.get('S3_BUCKET_NAME')
+S3_FILE_KEY = os.environ.get('S3_FILE_KEY')
+DOCUMENT_ID = os.environ.get('DOCUMENT_ID')
 DYNAMODB_TABLE_NAME = os.environ['DYNAMODB_TABLE_NAME']
 TEMP_BUCKET_NAME = os.environ['TEMP_BUCKET_NAME']
 EMBEDDINGS_ENDPOINT_NAME = os.environ['EMBEDDINGS_ENDPOINT_NAME']
 OUTPUT_BUCKET_NAME = os.environ["OUTPUT_BUCKET_NAME"]
+# embed, delete or worker
+TASK_ACTION = os.environ.get("TASK_ACTION", "embed")
+# Step Functions task token of the pipeline execution waiting on this document
+TASK_TOKEN = os.environ.get("TASK_TOKEN")
+
+# Worker mode: document jobs are pulled from this SQS queue until the task is stopped
+EMBEDDING_QUEUE_URL = os.environ.get("EMBEDDING_QUEUE_URL")
+WORKER_BATCH_MESSAGES = int(os.environ.get("WORKER_BATCH_MESSAGES", "10"))
+# A failed job is retried on later receives; on the last one, which must match the
+# queue's maxReceiveCount, the document is failed and the message left to the DLQ
+WORKER_MAX_RECEIVES = int(os.environ.get("WORKER_MAX_RECEIVES", "3"))
+WORKER_RETRY_DELAY_SECONDS = 60
+# Messages still being processed are kept invisible in steps of this long
+WORKER_VISIBILITY_TIMEOUT_SECONDS = int(os.environ.get("WORKER_VISIBILITY_TIMEOUT_SECONDS", "1800"))
+WORKER_HEARTBEAT_SECONDS = WORKER_VISIBILITY_TIMEOUT_SECONDS // 3
+
+# Corpus index: every document is also merged into one of CORPUS_SHARDS shared
+# indexes, so the chat can search the whole corpus without loading N archives.
+CORPUS_INDEX_ENABLED = os.environ.get("CORPUS_INDEX_ENABLED", "False").upper() == "TRUE"
+CORPUS_SHARDS = int(os.environ.get("CORPUS_SHARDS", "1"))
+CORPUS_PREFIX = "corpus"
+CORPUS_MANIFEST_KEY = f"{CORPUS_PREFIX}/manifest.json"
+CORPUS_UPDATE_ATTEMPTS = 10
+# Superseded shard versions are deleted once older than this, so chats that read
+# the previous manifest can still load them and uploads in flight are left alone
+CORPUS_GC_AGE = timedelta(hours=1)
+
+# Chunks sent per invoke_endpoint call, and calls in flight at once
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "20"))
+EMBEDDING_CONCURRENCY = int(os.environ.get("EMBEDDING_CONCURRENCY", "4"))
+EMBEDDING_MAX_ATTEMPTS = int(os.environ.get("EMBEDDING_MAX_ATTEMPTS", "5"))
+# Scale vectors to unit length, so L2 search ranks chunks by cosine similarity
+EMBEDDING_NORMALIZE = os.environ.get("EMBEDDING_NORMALIZE", "False").upper() == "TRUE"
+# Optional DynamoDB table remembering chunk vectors across document versions
+EMBEDDING_CACHE_TABLE_NAME = os.environ.get("EMBEDDING_CACHE_TABLE_NAME")
+
+# Index stored in the per document archive: flat, hnsw, sq8 or ivfpq.
+# Anything but flat is checked against the flat index with INDEX_RECALL_QUERIES
+# sampled chunks, and ivfpq falls back to sq8 below IVFPQ_MIN_VECTORS vectors,
+# where there is too little data to train its codebooks.
+INDEX_TYPE = os.environ.get("INDEX_TYPE", "flat").lower()
+INDEX_RECALL_QUERIES = 100
+INDEX_RECALL_K = 4
+# Queries are sampled chunks moved by this share of each dimension's spread, so
+# recall is not inflated by searching for vectors stored in the index verbatim
+INDEX_RECALL_NOISE = 0.5
+IVFPQ_MIN_VECTORS = 10000
 
 config = botocore.config.Config(
     read_timeout=1800,
     connect_timeout=1800,
-    retries={"max_attempts": 0}
+    retries={"max_attempts": EMBEDDING_MAX_ATTEMPTS, "mode": "adaptive"},
+    max_pool_connections=EMBEDDING_CONCURRENCY
 )
-
-class Document:
-    def __init__(self, page_content, metadata):
-        self.page_content = page_content
-        self.metadata = metadata
+sagemaker_runtime = boto3.client('sagemaker-runtime', config=config)
+stepfunctions = boto3.client('stepfunctions')
 
 class ContentHandler(EmbeddingsContentHandler):
     content_type = "application/json"
@@ -74,8 +135,8 @@ class ContentHandler(EmbeddingsContentHandler):
     def transform_input(self, prompts: List[str], model_kwargs: Dict) -> bytes:
         return json.dumps({"inputs": prompts}).encode('utf-8')
 
-    def transform_output(self, output: bytes) -> List[List[float]]:
-        return json.loads(output.read().decode("utf-8"))["vectors"]
+    def transform_output(self, output: bytes) -> np.ndarray:
+        return np.asarray(json.loads(output.read().decode("utf-8"))["vectors"], dtype=np.float32)
 
 def mark_document_as_failed(document_id, table_name):
     table = dynamodb.Table(table_name)
@@ -85,9 +146,66 @@ def mark_document_as_failed(document_id, table_name):
         ExpressionAttributeValues={':status': "Failed"}
     )
 
+def report_success(task_token, output):
+    if task_token:
+        stepfunctions.send_task_success(taskToken=task_token, output=json.dumps(output))
+
+def report_failure(task_token, e):
+    if not task_token:
+        return
+    try:
+        stepfunctions.send_task_failure(
+            taskToken=task_token,
+            error='ClientError' if isinstance(e, ClientError) else 'UnexpectedError',
+            cause=str(e)[:32768]
+        )
+    except ClientError:
+        logger.error(traceback.format_exc())
+
 def upload_directory_to_s3(directory_path, bucket_name, document_name):
-    for filename in os.listdir(directory_path):
-        s3.upload_file(os.path.join(directory_path, filename), bucket_name, f'vectors/{document_name}/{filename}')
+    # The index goes last: readers version the directory by the ETag of index.faiss,
+    # which also records the ETag of the docstore it belongs to
+    prefix = f'vectors/{document_name}'
+    metadata = {}
+    for filename in sorted(os.listdir(directory_path), key=lambda name: name.endswith(".faiss")):
+        extra_args = {'Metadata': metadata} if filename.endswith(".faiss") else None
+        s3.upload_file(os.path.join(directory_path, filename), bucket_name, f'{prefix}/{filename}', ExtraArgs=extra_args)
+        if filename == "docstore.db":
+            metadata['docstore-etag'] = s3.head_object(Bucket=bucket_name, Key=f'{prefix}/{filename}')['ETag']
+
+def to_mappable_index(index, vectors):
+    """Exact single list IVF equivalent of a flat or sq8 index. faiss can only
+    memory map the inverted lists of IVF indexes; HNSW is returned as it is."""
+
+    dimension = vectors.shape[1]
+    if isinstance(index, faiss.IndexFlat):
+        mappable = faiss.IndexIVFFlat(faiss.IndexFlatL2(dimension), dimension, 1)
+    elif isinstance(index, faiss.IndexScalarQuantizer):
+        mappable = faiss.IndexIVFScalarQuantizer(
+            faiss.IndexFlatL2(dimension), dimension, 1, faiss.ScalarQuantizer.QT_8bit
+        )
+    else:
+        return index
+
+    mappable.train(vectors)
+    mappable.add(vectors)
+    mappable.make_direct_map()
+    return mappable
+
+def write_sqlite_docstore(path, vectorstore):
+    # Chunks keyed by docstore id plus the FAISS position -> id map, so readers
+    # can fetch the k chunks a search returns without loading the rest
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute("CREATE TABLE documents (id TEXT PRIMARY KEY, page_content TEXT NOT NULL, metadata TEXT NOT NULL)")
+        connection.execute("CREATE TABLE ids (position INTEGER PRIMARY KEY, id TEXT NOT NULL)")
+        connection.executemany("INSERT INTO ids VALUES (?, ?)", vectorstore.index_to_docstore_id.items())
+        documents = ((doc_id, vectorstore.docstore.search(doc_id)) for doc_id in vectorstore.index_to_docstore_id.values())
+        connection.executemany(
+            "INSERT INTO documents VALUES (?, ?, ?)",
+            ((doc_id, doc.page_content, json.dumps(doc.metadata)) for doc_id, doc in documents)
+        )
+    connection.close()
 
 def zip_folder(folder_path, output_path):
     with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
@@ -95,50 +213,542 @@ def zip_folder(folder_path, output_path):
             for file in files:
                 zipf.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), folder_path))
 
-def create_vector(text, key_name):
-    
-    embeddings = SagemakerEndpointEmbeddings(endpoint_name=EMBEDDINGS_ENDPOINT_NAME, region_name=os.environ['AWS_REGION'], content_handler=ContentHandler())
-    texts_objects = [Document(d['page_content'], d['metadata']) for d in text]
-    
-    vectorstore = None
-    for i in range(0, len(texts_objects), 20):
-        if vectorstore is None:
-            vectorstore = FAISS.from_documents(texts_objects[i : i + 20], embeddings)
+def get_vector_ids(document_id, start, count):
+    # Vector ids are derived from the document id, so the corpus manifest
+    # only needs to record how many vectors each document owns
+    return [f"{document_id}#{i}" for i in range(start, start + count)]
+
+def get_shard(document_id):
+    return zlib.crc32(document_id.encode("utf-8")) % CORPUS_SHARDS
+
+def read_corpus_manifest():
+    try:
+        response = s3.get_object(Bucket=OUTPUT_BUCKET_NAME, Key=CORPUS_MANIFEST_KEY)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ("NoSuchKey", "404"):
+            return {'version': 0, 'shards': {}, 'documents': {}}, None
+        raise
+    return json.loads(response['Body'].read().decode('utf-8')), response['ETag']
+
+def write_corpus_manifest(manifest, etag):
+    # Conditional write, so concurrent tasks cannot overwrite each other's updates
+    condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+    s3.put_object(
+        Bucket=OUTPUT_BUCKET_NAME,
+        Key=CORPUS_MANIFEST_KEY,
+        Body=json.dumps(manifest).encode('utf-8'),
+        ContentType='application/json',
+        **condition
+    )
+
+def load_corpus_shard(shard_entry, embeddings):
+    local_dir = f"/tmp/{CORPUS_PREFIX}/{os.path.basename(shard_entry['key'])[:-4]}"
+    local_zip = local_dir + ".zip"
+    os.makedirs(os.path.dirname(local_zip), exist_ok=True)
+    s3.download_file(OUTPUT_BUCKET_NAME, shard_entry['key'], local_zip)
+    with zipfile.ZipFile(local_zip, 'r') as zf:
+        zf.extractall(local_dir)
+    os.remove(local_zip)
+    return FAISS.load_local(local_dir, embeddings)
+
+def delete_stale_shards(shard, keep):
+    """Delete versions of a shard that no manifest points at any more."""
+    cutoff = datetime.now(timezone.utc) - CORPUS_GC_AGE
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=OUTPUT_BUCKET_NAME, Prefix=f"{CORPUS_PREFIX}/shard-{shard}/"):
+        for obj in page.get('Contents', []):
+            if obj['Key'] not in keep and obj['LastModified'] < cutoff:
+                s3.delete_object(Bucket=OUTPUT_BUCKET_NAME, Key=obj['Key'])
+                logger.info(f"Deleted superseded corpus shard {obj['Key']}")
+
+def update_corpus(document_id, embeddings, vectorstore=None):
+    """Merge a document's vectors into its corpus shard, or remove them when
+    vectorstore is None. Each change writes a new shard version and then the
+    manifest; the manifest write is retried if another task got there first.
+    Shard keys are unique per upload, so a task that loses the race only ever
+    deletes its own upload."""
+
+    shard = str(get_shard(document_id))
+
+    for attempt in range(CORPUS_UPDATE_ATTEMPTS):
+        manifest, etag = read_corpus_manifest()
+        shard_entry = manifest['shards'].get(shard)
+        previous = manifest['documents'].get(document_id)
+
+        if vectorstore is None and previous is None:
+            logger.info(f"Document {document_id} is not in the corpus index")
+            return
+
+        shard_store = load_corpus_shard(shard_entry, embeddings) if shard_entry else None
+        if shard_store is not None and previous is not None:
+            shard_store.delete(get_vector_ids(document_id, 0, previous['count']))
+        if vectorstore is not None:
+            if shard_store is None:
+                shard_store = vectorstore
+            else:
+                shard_store.merge_from(vectorstore)
+
+        version = manifest['version'] + 1
+        upload_id = uuid.uuid4().hex
+        shard_key = f"{CORPUS_PREFIX}/shard-{shard}/v{version}-{upload_id}-vectorstore.pkl.zip"
+        output_path = f"/tmp/{CORPUS_PREFIX}/shard-{shard}-v{version}-{upload_id}"
+        shard_store.save_local(output_path)
+        zip_folder(output_path, output_path + ".zip")
+        s3.upload_file(output_path + ".zip", OUTPUT_BUCKET_NAME, shard_key)
+        shutil.rmtree(output_path, ignore_errors=True)
+        os.remove(output_path + ".zip")
+
+        manifest['version'] = version
+        manifest['shards'][shard] = {'key': shard_key, 'version': version}
+        if vectorstore is not None:
+            manifest['documents'][document_id] = {
+                'shard': int(shard),
+                'count': len(vectorstore.index_to_docstore_id)
+            }
         else:
-            vectorstore.add_documents(texts_objects[i : i + 20])
+            del manifest['documents'][document_id]
+
+        try:
+            write_corpus_manifest(manifest, etag)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ("PreconditionFailed", "ConditionalRequestConflict", "412"):
+                raise
+            logger.info(f"Corpus manifest changed concurrently, retrying (attempt {attempt + 1})")
+            s3.delete_object(Bucket=OUTPUT_BUCKET_NAME, Key=shard_key)
+            continue
+
+        logger.info(f"Corpus index version {version} written for shard {shard}")
+        try:
+            delete_stale_shards(shard, {shard_key, shard_entry['key'] if shard_entry else None})
+        except ClientError:
+            logger.error(traceback.format_exc())
+        return
+
+    raise RuntimeError(f"Could not update corpus index for {document_id}")
+
+def get_embeddings():
+    return SagemakerEndpointEmbeddings(endpoint_name=EMBEDDINGS_ENDPOINT_NAME, region_name=os.environ['AWS_REGION'], content_handler=ContentHandler())
+
+def invoke_embeddings(texts):
+    # Throttling is retried by botocore; model errors get exponential backoff with jitter
+    content_handler = ContentHandler()
+    body = content_handler.transform_input(texts, {})
+
+    for attempt in range(EMBEDDING_MAX_ATTEMPTS):
+        try:
+            response = sagemaker_runtime.invoke_endpoint(
+                EndpointName=EMBEDDINGS_ENDPOINT_NAME,
+                Body=body,
+                ContentType=content_handler.content_type,
+                Accept=content_handler.accepts
+            )
+            return content_handler.transform_output(response['Body'])
+        except ClientError as e:
+            if attempt == EMBEDDING_MAX_ATTEMPTS - 1:
+                raise
+            delay = min(2 ** attempt, 30) * random.uniform(0.5, 1.0)
+            logger.warning(f"Embedding batch failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def chunk_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def get_chunk_key(text_hash):
+    return {
+        'id': f"CHUNK#{EMBEDDINGS_ENDPOINT_NAME}#{text_hash}",
+        'connection_id': "CHUNK",
+    }
+
+def read_chunk_vectors(hashes):
+    """Return the cached raw vectors for the given chunk hashes."""
+
+    if not EMBEDDING_CACHE_TABLE_NAME:
+        return {}
+
+    found = {}
+    for i in range(0, len(hashes), 100):
+        request = {EMBEDDING_CACHE_TABLE_NAME: {'Keys': [get_chunk_key(h) for h in hashes[i : i + 100]]}}
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(EMBEDDING_CACHE_TABLE_NAME, []):
+                found[item['id'].rsplit('#', 1)[1]] = np.frombuffer(item['vector'].value, dtype=np.float32)
+            request = response.get('UnprocessedKeys')
+            if request:
+                time.sleep(0.5)
+    return found
+
+def write_chunk_vectors(hashes, vectors):
+    if not EMBEDDING_CACHE_TABLE_NAME:
+        return
+
+    table = dynamodb.Table(EMBEDDING_CACHE_TABLE_NAME)
+    with table.batch_writer(overwrite_by_pkeys=['id', 'connection_id']) as batch:
+        for text_hash, vector in zip(hashes, vectors):
+            batch.put_item(Item={**get_chunk_key(text_hash), 'vector': vector.tobytes()})
+
+def invoke_batches(texts):
+    batches = [texts[i : i + EMBEDDING_BATCH_SIZE] for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)]
+    logger.info(f"Embedding {len(texts)} chunks in {len(batches)} batches")
+
+    # Each batch is copied into one preallocated buffer as it completes
+    vectors = None
+    with ThreadPoolExecutor(max_workers=EMBEDDING_CONCURRENCY) as executor:
+        for i, batch_vectors in enumerate(executor.map(invoke_embeddings, batches)):
+            if vectors is None:
+                vectors = np.empty((len(texts), batch_vectors.shape[1]), dtype=np.float32)
+            start = i * EMBEDDING_BATCH_SIZE
+            vectors[start : start + len(batch_vectors)] = batch_vectors
+
+    return vectors
+
+def embed_texts(texts):
+    """Embed chunks, returning the vectors and a mask of the chunks that were
+    sent to the endpoint; every other chunk reused an existing vector.
+
+    Chunks are identified by the SHA-256 of their text, so repeated chunks and
+    chunks already embedded for an earlier version skip the endpoint."""
+
+    hashes = [chunk_hash(text) for text in texts]
+    unique = dict(zip(hashes, texts))
+    cached = read_chunk_vectors(list(unique))
+    missing = [text_hash for text_hash in unique if text_hash not in cached]
+
+    fresh = invoke_batches([unique[text_hash] for text_hash in missing]) if missing else None
+    if missing:
+        write_chunk_vectors(missing, fresh)
+
+    dimension = fresh.shape[1] if fresh is not None else next(iter(cached.values())).shape[0]
+    position = {text_hash: i for i, text_hash in enumerate(unique)}
+    vectors = np.empty((len(unique), dimension), dtype=np.float32)
+    for text_hash, vector in cached.items():
+        vectors[position[text_hash]] = vector
+    if missing:
+        vectors[[position[text_hash] for text_hash in missing]] = fresh
+    if len(unique) < len(texts):
+        vectors = vectors[[position[text_hash] for text_hash in hashes]]
+
+    if EMBEDDING_NORMALIZE:
+        faiss.normalize_L2(vectors)
+
+    embedded = np.zeros(len(texts), dtype=bool)
+    pending = set(missing)
+    for i, text_hash in enumerate(hashes):
+        if text_hash in pending:
+            embedded[i] = True
+            pending.discard(text_hash)
+
+    logger.info(
+        f"Chunks: {len(texts)} total, {len(texts) - len(unique)} duplicates, "
+        f"{len(cached)} from cache, {len(missing)} embedded"
+    )
+    return vectors, embedded
+
+def create_index(vectors, index_type):
+    dimension = vectors.shape[1]
+
+    if index_type == "ivfpq" and len(vectors) < IVFPQ_MIN_VECTORS:
+        logger.info(f"Only {len(vectors)} vectors, using sq8 instead of ivfpq")
+        index_type = "sq8"
+
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, 32)
+        index.hnsw.efSearch = 64
+    elif index_type == "sq8":
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit)
+        index.train(vectors)
+    elif index_type == "ivfpq":
+        nlist = int(np.sqrt(len(vectors)))
+        # Up to 64 sub-quantizers of 8 bits: 64 bytes per vector instead of
+        # 4 * dimension. Their count must divide the dimension.
+        subquantizers = max(m for m in range(1, 65) if dimension % m == 0)
+        index = faiss.IndexIVFPQ(faiss.IndexFlatL2(dimension), dimension, nlist, subquantizers, 8)
+        index.train(vectors)
+        index.nprobe = min(nlist, 16)
+    else:
+        index = faiss.IndexFlatL2(dimension)
+
+    # All vectors are added to the index in a single call
+    index.add(vectors)
+
+    # IVF indexes cannot reconstruct stored vectors, which MMR search needs
+    if isinstance(index, faiss.IndexIVF):
+        index.make_direct_map()
+
+    return index
+
+def measure_recall(baseline_index, index, vectors):
+    # Share of the exact top k neighbours of perturbed sample chunks the index also returns
+    rng = np.random.default_rng(0)
+    sample = rng.choice(len(vectors), min(INDEX_RECALL_QUERIES, len(vectors)), replace=False)
+    noise = rng.normal(size=(len(sample), vectors.shape[1])) * vectors.std(axis=0) * INDEX_RECALL_NOISE
+    queries = (vectors[sample] + noise).astype(np.float32)
+    k = min(INDEX_RECALL_K, len(vectors))
+
+    _, expected = baseline_index.search(queries, k)
+    _, found = index.search(queries, k)
+    hits = sum(len(set(e) & set(f)) for e, f in zip(expected, found))
+    return hits / (len(queries) * k)
+
+def build_vectorstore(texts, metadatas, vectors, ids, embeddings):
+    index = create_index(vectors, "flat")
+
+    docstore = InMemoryDocstore({
+        doc_id: Document(page_content=text, metadata=metadata)
+        for doc_id, text, metadata in zip(ids, texts, metadatas)
+    })
+    index_to_docstore_id = dict(enumerate(ids))
+    return FAISS(embeddings.embed_query, index, docstore, index_to_docstore_id)
+
+def create_vector(text, key_name, document_id=DOCUMENT_ID, dynamodb_table_name=DYNAMODB_TABLE_NAME, task_token=TASK_TOKEN):
+    
+    # Embed everything first, then build the index once
+    vectors, embedded = embed_texts([d['page_content'] for d in text])
+    store_vectors(text, key_name, document_id, dynamodb_table_name, vectors, embedded, task_token)
+
+def store_vectors(text, key_name, document_id, dynamodb_table_name, vectors, embedded, task_token=None):
+    """Build, upload and register the vectorstore of one document from its embedded
+    chunks, then tell the waiting pipeline execution, if any."""
+
+    embeddings = get_embeddings()
+    texts = [d['page_content'] for d in text]
+    metadatas = [d['metadata'] for d in text]
+
+    vectorstore = build_vectorstore(
+        texts, metadatas, vectors, get_vector_ids(document_id, 0, len(texts)), embeddings
+    )
+
+    # The archive may use a compressed index; the corpus index stays flat so shards can be merged
+    archive_vectorstore = vectorstore
+    index_recall = Decimal(1)
+    if INDEX_TYPE != "flat":
+        index = create_index(vectors, INDEX_TYPE)
+        recall = measure_recall(vectorstore.index, index, vectors)
+        logger.info(f"{INDEX_TYPE} index recall@{INDEX_RECALL_K} against flat: {recall:.4f}")
+        index_recall = Decimal(str(round(recall, 4)))
+        archive_vectorstore = FAISS(
+            embeddings.embed_query, index, vectorstore.docstore, vectorstore.index_to_docstore_id
+        )
            
     output_path = f'/tmp/{key_name}-vectorstore.pkl'
-    vectorstore.save_local(output_path)
+    archive_vectorstore.save_local(output_path)
    
     output_zip_path = output_path + ".zip"
     zip_folder(output_path, output_zip_path)
     
-    zip_s3_key = f"s3://{OUTPUT_BUCKET_NAME}/{os.path.basename(output_zip_path)}"
-    s3.upload_file(output_zip_path, OUTPUT_BUCKET_NAME, os.path.basename(output_zip_path))
+    # Keyed by the full document name, like the vectors/ copy, so documents with the
+    # same file name in different folders do not overwrite each other's archive
+    zip_key = f"{key_name}-vectorstore.pkl.zip"
+    zip_s3_key = f"s3://{OUTPUT_BUCKET_NAME}/{zip_key}"
+    s3.upload_file(output_zip_path, OUTPUT_BUCKET_NAME, zip_key)
+
+    # Uncompressed copy the chat can download and memory map without extracting,
+    # with the pickled docstore replaced by one that is read lazily
+    faiss.write_index(to_mappable_index(archive_vectorstore.index, vectors), os.path.join(output_path, "index.faiss"))
+    write_sqlite_docstore(os.path.join(output_path, "docstore.db"), archive_vectorstore)
+    os.remove(os.path.join(output_path, "index.pkl"))
+    upload_directory_to_s3(output_path, OUTPUT_BUCKET_NAME, key_name)
+
+    # Workers handle many documents, so the local copies are not left behind
+    shutil.rmtree(output_path, ignore_errors=True)
+    os.remove(output_zip_path)
     
-    table = dynamodb.Table(DYNAMODB_TABLE_NAME)
+    # The corpus goes first, so a document is only Completed once it is searchable everywhere
+    if CORPUS_INDEX_ENABLED:
+        update_corpus(document_id, embeddings, vectorstore)
+
+    table = dynamodb.Table(dynamodb_table_name)
     table.update_item(
-        Key={'id': DOCUMENT_ID},
-        UpdateExpression="SET document_status = :status, vector = :vector",
-        ExpressionAttributeValues={':status': "Completed", ':vector': zip_s3_key}
+        Key={'id': document_id},
+        UpdateExpression="SET document_status = :status, vector = :vector, index_type = :index_type, index_recall = :index_recall, chunks_reused = :chunks_reused, chunks_embedded = :chunks_embedded",
+        ExpressionAttributeValues={
+            ':status': "Completed",
+            ':vector': zip_s3_key,
+            ':index_type': INDEX_TYPE,
+            ':index_recall': index_recall,
+            ':chunks_reused': int(len(embedded) - embedded.sum()),
+            ':chunks_embedded': int(embedded.sum())
+        }
     )
 
-if __name__ == "__main__":
-    logger.info("Starting ECS task script...")
+    report_success(task_token, {
+        'document_id': document_id,
+        'document_status': "Completed",
+        'vector': zip_s3_key,
+        'chunks_reused': int(len(embedded) - embedded.sum()),
+        'chunks_embedded': int(embedded.sum())
+    })
+
+def read_document_chunks(bucket_name, key):
+    """Read the extracted chunks, either a single JSON array or, when the key is a
+    prefix, the JSON Lines shards written by the streaming extraction."""
+
+    if not key.endswith("/"):
+        return json.loads(s3.get_object(Bucket=bucket_name, Key=key)['Body'].read().decode('utf-8'))
+
+    chunks = []
+    paginator = s3.get_paginator('list_objects_v2')
+    # The delimiter keeps out the shards of documents in a folder of the same name
+    for listing in paginator.paginate(Bucket=bucket_name, Prefix=key, Delimiter="/"):
+        for obj in sorted(listing.get('Contents', []), key=lambda o: o['Key']):
+            body = s3.get_object(Bucket=bucket_name, Key=obj['Key'])['Body']
+            for line in body.iter_lines():
+                if line:
+                    chunks.append(json.loads(line))
+    logger.info(f"Read {len(chunks)} chunks from s3://{bucket_name}/{key}")
+    return chunks
+
+def get_document_name(key):
+    name = key.replace("documents/", "", 1)
+    # A streamed extraction is a prefix named after the document itself, dots included
+    if name.endswith("/"):
+        return name.rstrip("/")
+    return os.path.splitext(name)[0]
+
+def process_jobs(sqs, messages, in_flight):
+    """Embed the chunks of every received document in one pass, then store each document.
+    If that pass fails, each document is embedded on its own so one bad document
+    cannot fail the others."""
+
+    jobs = []
+    for message in messages:
+        job = json.loads(message['Body'])
+        try:
+            jobs.append((message, job, read_document_chunks(job['bucket'], job['key'])))
+        except Exception as e:
+            fail_job(sqs, message, job, e, in_flight)
+
+    if not jobs:
+        return
+
+    texts = [d['page_content'] for _, _, chunks in jobs for d in chunks]
+    logger.info(f"Embedding {len(texts)} chunks from {len(jobs)} documents")
     try:
-        document_name = os.path.splitext(S3_FILE_KEY.replace("documents/", ""))[0]
-        document_content = json.loads(s3.get_object(Bucket=S3_BUCKET_NAME, Key=S3_FILE_KEY)['Body'].read().decode('utf-8'))
-        print(document_content)
-        print(document_name)
-        create_vector(document_content, document_name)
-
-    except Exception as e:  # Catching all exceptions
-        mark_document_as_failed(DOCUMENT_ID, DYNAMODB_TABLE_NAME)
-        error_type = 'ClientError' if isinstance(e, ClientError) else 'UnexpectedError'
+        vectors, embedded = embed_texts(texts)
+    except Exception:
         logger.error(traceback.format_exc())
-        logger.error(f"{error_type} error for bucket: {S3_BUCKET_NAME}, key: {S3_FILE_KEY}. Error: {str(e)}")
-        logger.error(f"Encountered errors: {str(e)}")
+        logger.warning("Batch embedding failed, embedding documents one at a time")
+        vectors, embedded = None, None
+
+    start = 0
+    for message, job, chunks in jobs:
+        end = start + len(chunks)
+        try:
+            if vectors is None:
+                job_vectors, job_embedded = embed_texts([d['page_content'] for d in chunks])
+            else:
+                job_vectors, job_embedded = vectors[start:end], embedded[start:end]
+            store_vectors(
+                chunks, get_document_name(job['key']), job['document_id'], job['dynamodb_table_name'],
+                job_vectors, job_embedded, job.get('task_token')
+            )
+        except Exception as e:
+            fail_job(sqs, message, job, e, in_flight)
+        else:
+            release_message(sqs, message, in_flight)
+            logger.info(f"Document {job['document_id']} embedded")
+        start = end
+
+def fail_job(sqs, message, job, e, in_flight):
+    logger.error(traceback.format_exc())
+    receive_count = int(message['Attributes']['ApproximateReceiveCount'])
+    if receive_count < WORKER_MAX_RECEIVES:
+        logger.warning(f"Attempt {receive_count} failed for document {job.get('document_id')}, retrying: {str(e)}")
+        release_message(sqs, message, in_flight, WORKER_RETRY_DELAY_SECONDS * receive_count)
+        return
+
+    logger.error(f"Embedding failed for document {job.get('document_id')}: {str(e)}")
+    report_failure(job.get('task_token'), e)
+    mark_document_as_failed(job['document_id'], job['dynamodb_table_name'])
+    # Received once more, the message moves to the dead letter queue
+    release_message(sqs, message, in_flight, 0)
+
+def release_message(sqs, message, in_flight, visibility_timeout=None):
+    """Delete a processed message, or make it visible again after visibility_timeout seconds."""
+
+    with in_flight['lock']:
+        in_flight['messages'].pop(message['MessageId'], None)
+        if visibility_timeout is None:
+            sqs.delete_message(QueueUrl=EMBEDDING_QUEUE_URL, ReceiptHandle=message['ReceiptHandle'])
+        else:
+            sqs.change_message_visibility(
+                QueueUrl=EMBEDDING_QUEUE_URL,
+                ReceiptHandle=message['ReceiptHandle'],
+                VisibilityTimeout=visibility_timeout
+            )
+
+def keep_messages_invisible(sqs, in_flight, stop):
+    """Extend the visibility timeout of the messages being processed until stop is set,
+    so a batch that takes longer than the queue's timeout is not received twice."""
+
+    while not stop.wait(WORKER_HEARTBEAT_SECONDS):
+        with in_flight['lock']:
+            entries = [
+                {
+                    'Id': message_id,
+                    'ReceiptHandle': message['ReceiptHandle'],
+                    'VisibilityTimeout': WORKER_VISIBILITY_TIMEOUT_SECONDS
+                }
+                for message_id, message in in_flight['messages'].items()
+            ]
+            if not entries:
+                continue
+            try:
+                response = sqs.change_message_visibility_batch(QueueUrl=EMBEDDING_QUEUE_URL, Entries=entries)
+            except ClientError:
+                logger.error(traceback.format_exc())
+                continue
+        for failure in response.get('Failed', []):
+            logger.warning(f"Could not extend visibility of message {failure['Id']}: {failure.get('Message')}")
+
+def run_worker():
+    sqs = boto3.client('sqs')
+    logger.info(f"Worker polling {EMBEDDING_QUEUE_URL}")
+    while True:
+        response = sqs.receive_message(
+            QueueUrl=EMBEDDING_QUEUE_URL,
+            MaxNumberOfMessages=WORKER_BATCH_MESSAGES,
+            AttributeNames=['ApproximateReceiveCount'],
+            WaitTimeSeconds=20
+        )
+        messages = response.get('Messages', [])
+        if not messages:
+            continue
+
+        in_flight = {'lock': threading.Lock(), 'messages': {m['MessageId']: m for m in messages}}
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=keep_messages_invisible, args=(sqs, in_flight, stop), daemon=True)
+        heartbeat.start()
+        try:
+            process_jobs(sqs, messages, in_flight)
+        finally:
+            stop.set()
+            heartbeat.join()
+
+if __name__ == "__main__":
+    if TASK_ACTION == "worker":
+        # Runs until the service stops the task
+        run_worker()
     else:
-        logger.info(f"Processed files from bucket: {S3_BUCKET_NAME}")
+        logger.info("Starting ECS task script...")
+        try:
+            if TASK_ACTION == "delete":
+                # Only the corpus index is touched; the per document archive is left as is
+                update_corpus(DOCUMENT_ID, get_embeddings())
+            else:
+                document_name = get_document_name(S3_FILE_KEY)
+                document_content = read_document_chunks(S3_BUCKET_NAME, S3_FILE_KEY)
+                print(len(document_content))
+                print(document_name)
+                create_vector(document_content, document_name)
+
+        except Exception as e:  # Catching all exceptions
+            report_failure(TASK_TOKEN, e)
+            mark_document_as_failed(DOCUMENT_ID, DYNAMODB_TABLE_NAME)
+            error_type = 'ClientError' if isinstance(e, ClientError) else 'UnexpectedError'
+            logger.error(traceback.format_exc())
+            logger.error(f"{error_type} error for bucket: {S3_BUCKET_NAME}, key: {S3_FILE_KEY}. Error: {str(e)}")
+            logger.error(f"Encountered errors: {str(e)}")
+        else:
+            logger.info(f"Processed files from bucket: {S3_BUCKET_NAME}")
 
-    logger.info("ECS task script completed.")
\ No newline at end of file
+        logger.info("ECS task script completed.")
\ No newline at end of file
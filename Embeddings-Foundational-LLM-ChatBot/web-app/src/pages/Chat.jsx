@@ -26,7 +26,7 @@
 // --  -----------------------------------------------------------------
 // --
 
-import { API, Auth } from "aws-amplify";
+import { API, Auth, Signer } from "aws-amplify";
 import { useState, useEffect, useRef } from "react";
 import "@chatscope/chat-ui-kit-styles/dist/default/styles.min.css";
 import { Avatar } from "@chatscope/chat-ui-kit-react";
@@ -228,9 +228,95 @@ export function Chat() {
       throw new Error("API call failed after maximum retries");
     }
 
+    // The chat function URL streams the answer as JSON lines: {"token": ...}
+    // while it is generated, then the full response body as the last line
+    async function streamAPICall(onToken) {
+      const endpoint = await API.endpoint("chatApi");
+      const region = endpoint.match(/lambda-url\.([a-z0-9-]+)\.on\.aws/)[1];
+      const credentials = await Auth.currentCredentials();
+      const data = JSON.stringify({ ...listMsg, stream: true });
+      const signed = Signer.sign(
+        {
+          method: "POST",
+          url: endpoint,
+          headers: { "content-type": "application/json" },
+          data: data,
+        },
+        {
+          access_key: credentials.accessKeyId,
+          secret_key: credentials.secretAccessKey,
+          session_token: credentials.sessionToken,
+        },
+        { service: "lambda", region: region }
+      );
+      // Set by the browser itself
+      delete signed.headers.host;
+
+      const response = await fetch(endpoint, {
+        method: "POST",
+        headers: signed.headers,
+        body: data,
+      });
+      if (!response.ok) {
+        throw new Error(`Chat request failed with status ${response.status}`);
+      }
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffered = "";
+      let result = null;
+      for (;;) {
+        const { done, value } = await reader.read();
+        if (done) {
+          break;
+        }
+        buffered += decoder.decode(value, { stream: true });
+        const lines = buffered.split("\n");
+        buffered = lines.pop();
+        for (const line of lines) {
+          if (!line) {
+            continue;
+          }
+          const event = JSON.parse(line);
+          if ("token" in event) {
+            onToken(event.token);
+          } else if ("error" in event) {
+            throw new Error(event.error);
+          } else {
+            result = event;
+          }
+        }
+      }
+
+      if (result === null) {
+        throw new Error("Chat stream ended without an answer");
+      }
+      return result;
+    }
+
+    async function answerQuestion() {
+      let streamed = "";
+      try {
+        return await streamAPICall((token) => {
+          streamed += token;
+          setIsThinking(false);
+          setMessages([
+            ...chatMessages,
+            {
+              message: streamed,
+              sender: "Guru",
+            },
+          ]);
+        });
+      } catch (error) {
+        console.error("Streamed API call failed:", error);
+        return retryAPICall();
+      }
+    }
+
     const getData = async () => {
       try {
-        const data = await retryAPICall();
+        const data = await answerQuestion();
         if (conversationId.length === 0) {
           setConversationId(data["conversation_id"]);
         }